@@ -7,6 +7,9 @@ and syncing with Streamlit's session_state.
 from __future__ import annotations
 
 import json
+import os
+import tempfile
+from functools import lru_cache
 from pathlib import Path
 import streamlit as st
 from .paths import get_global_config_json_path
@@ -51,6 +54,8 @@ def _default_config() -> dict:
     "openrouter_model": "google/gemini-3.1-flash-lite-preview",
     # Automatically run consultation after retrieval completes
     "auto_consult": True,
+    # Save the open conversation in the background after each reply
+    "autosave_conversations": False,
     # Max allowed size for the user's SQLite DB in megabytes
     "db_size_limit_mb": 500,
         "ssh_host": "",
@@ -74,31 +79,57 @@ def _default_config() -> dict:
     }
 
 
-def _read_file_config() -> dict:
-    path = Path(_get_active_config_path())
-    if not path.exists():
-        return {}
+@lru_cache(maxsize=16)
+def _parse_json_file(path: str, mtime_ns: int, size: int) -> dict:
+    """Parsed JSON for one version of a file; (mtime, size) in the key invalidates edits."""
     try:
-        with path.open("r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f) or {}
     except Exception:
         # On any parse error, fall back to defaults without crashing the UI
         return {}
 
 
+def _read_json_cached(path) -> dict:
+    """Read a JSON config file, re-parsing only when it changed on disk."""
+    try:
+        st_ = os.stat(path)
+    except OSError:
+        return {}
+    # Shallow copy so callers can update the result without touching the cache
+    return dict(_parse_json_file(str(path), st_.st_mtime_ns, st_.st_size))
+
+
+def _read_file_config() -> dict:
+    return _read_json_cached(_get_active_config_path())
+
+
+def _replace_json(path: Path, data: dict) -> None:
+    """Write JSON to a sibling temp file, then rename over `path`.
+
+    Readers (including a concurrent rerun) see the old or the new file, never a partial one.
+    """
+    # Unique per call: concurrent saves (sessions are threads) never share a temp file.
+    # mkstemp creates it 0600, so the config is never readable by others.
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+    finally:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+    _parse_json_file.cache_clear()
+
+
 def _write_file_config(cfg: dict) -> None:
     path = Path(_get_active_config_path())
     # Ensure parent directory exists (for per-user paths)
     path.parent.mkdir(parents=True, exist_ok=True)
     try:
-        with path.open("w", encoding="utf-8") as f:
-            json.dump(cfg, f, indent=2)
-        # Restrict permissions to user read/write only
-        try:
-            import os as _os
-            _os.chmod(path, 0o600)
-        except Exception:
-            pass
+        _replace_json(path, cfg)
     except Exception:
         # If writing fails, still keep session_state updated
         pass
@@ -147,33 +178,22 @@ def save_configuration(config: dict) -> None:
     # Only persist known keys
     filtered = {k: v for k, v in (config or {}).items() if k in allowed_keys}
     new_cfg = _merge(current, filtered)
+    if new_cfg == current:
+        # Nothing changed: skip the rewrite
+        return
     _write_file_config(new_cfg)
 
 
 # -------- Admin/global settings helpers --------
 def _read_json(path: str) -> dict:
-    p = Path(path)
-    if not p.exists():
-        return {}
-    try:
-        with p.open("r", encoding="utf-8") as f:
-            return json.load(f) or {}
-    except Exception:
-        return {}
+    return _read_json_cached(path)
 
 
 def _write_json(path: str, data: dict) -> None:
     p = Path(path)
     p.parent.mkdir(parents=True, exist_ok=True)
     try:
-        with p.open("w", encoding="utf-8") as f:
-            json.dump(data or {}, f, indent=2)
-        # Best-effort: restrict permissions on config files
-        try:
-            import os as _os
-            _os.chmod(p, 0o600)
-        except Exception:
-            pass
+        _replace_json(p, data or {})
     except Exception:
         pass
 
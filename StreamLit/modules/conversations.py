@@ -11,6 +11,52 @@ def _slugify(name: str) -> str:
     safe = "-".join(safe.split())
     return safe[:100] or f"session-{int(time.time())}"
 
+def new_conversation_id(messages: List[Dict[str, str]], title: Optional[str] = None) -> str:
+    """Id used for a conversation's file name, derived from its title or first message."""
+    now = int(time.time())
+    base = _slugify(title or (messages[0]["content"][:50] if messages else f"session-{now}"))
+    return f"{base}-{now}"
+
+def _table_to_b64(table) -> str:
+    """Serialize a pyarrow Table to a base64 Arrow IPC stream (JSON-safe)."""
+    import pyarrow as pa
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii")
+
+def _table_from_b64(data: str):
+    import pyarrow as pa
+    return pa.ipc.open_stream(base64.b64decode(data)).read_all()
+
+def _encode_batches(batches: Optional[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Snapshot retrieved result sets; items without an Arrow table are skipped."""
+    out = []
+    for b in (batches or []):
+        table = b.get("table")
+        if not hasattr(table, "schema"):
+            continue
+        try:
+            out.append({
+                "sql": b.get("sql"),
+                "label": b.get("label"),
+                "turn": b.get("turn"),
+                "arrow": _table_to_b64(table),
+            })
+        except Exception:
+            continue
+    return out
+
+def _decode_batches(batches: List[Dict[str, Any]]) -> List[Dict[str, Any]] | None:
+    """Inverse of _encode_batches; returns None if any snapshot cannot be read."""
+    try:
+        return [
+            {"sql": b.get("sql"), "label": b.get("label"), "turn": b.get("turn"), "table": _table_from_b64(b["arrow"])}
+            for b in batches
+        ]
+    except Exception:
+        return None
+
 def list_conversations(username: str, key: str) -> List[Dict[str, Any]]:
     conv_dir = get_user_conversations_dir(username)
     items = []
@@ -19,7 +65,8 @@ def list_conversations(username: str, key: str) -> List[Dict[str, Any]]:
             path = os.path.join(conv_dir, fname)
             try:
                 conv_id = fname[:-4]
-                conv = load_conversation(conv_id, username, key)
+                # Metadata only; skip decoding row snapshots
+                conv = _read_conversation(conv_id, username, key)
                 if conv:
                     items.append({
                         "id": conv_id,
@@ -40,14 +87,14 @@ def save_conversation(
     title: Optional[str] = None,
     conv_id: Optional[str] = None,
     sql_history: Optional[List[str]] = None,
+    batches: Optional[List[Dict[str, Any]]] = None,
 ) -> str:
     conv_dir = get_user_conversations_dir(username)
     fernet = _get_fernet(key)
     now = int(time.time())
     
     if not conv_id:
-        base = _slugify(title or (messages[0]["content"][:50] if messages else f"session-{now}"))
-        conv_id = f"{base}-{now}"
+        conv_id = new_conversation_id(messages, title)
     
     path = os.path.join(conv_dir, f"{conv_id}.enc")
     
@@ -59,7 +106,9 @@ def save_conversation(
         "messages": messages,
         # Persist successful SQL statements so rows can be reconstructed on load
         "sql_history": list(sql_history or []),
-        "version": 1,
+        # Snapshots of retrieved rows (with tab labels) so loading does not re-run SQL
+        "batches": _encode_batches(batches),
+        "version": 2,
     }
     
     encrypted_data = fernet.encrypt(json.dumps(data).encode('utf-8'))
@@ -74,7 +123,7 @@ def save_conversation(
         
     return conv_id
 
-def load_conversation(conv_id: str, username: str, key: str) -> Dict[str, Any] | None:
+def _read_conversation(conv_id: str, username: str, key: str) -> Dict[str, Any] | None:
     conv_dir = get_user_conversations_dir(username)
     path = os.path.join(conv_dir, f"{conv_id}.enc")
     
@@ -88,19 +137,28 @@ def load_conversation(conv_id: str, username: str, key: str) -> Dict[str, Any] |
         
     try:
         decrypted_data = fernet.decrypt(encrypted_data)
-        data = json.loads(decrypted_data.decode('utf-8'))
-        # Ensure keys exist for older files
-        if "sql_history" not in data:
-            data["sql_history"] = []
-        return data
+        return json.loads(decrypted_data.decode('utf-8'))
     except Exception:
         return None
 
+def load_conversation(conv_id: str, username: str, key: str) -> Dict[str, Any] | None:
+    data = _read_conversation(conv_id, username, key)
+    if data is None:
+        return None
+    # Ensure keys exist for older files
+    if "sql_history" not in data:
+        data["sql_history"] = []
+    # Version 1 files have no snapshots; unreadable snapshots fall back to SQL replay too
+    data["batches"] = _decode_batches(data.get("batches") or []) or []
+    return data
+
 def delete_conversation(conv_id: str, username: str) -> None:
     conv_dir = get_user_conversations_dir(username)
     path = os.path.join(conv_dir, f"{conv_id}.enc")
-    if os.path.exists(path):
-        os.remove(path)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
 
 def _get_fernet(key: str) -> Fernet:
     """Derive a valid Fernet key from the user's key."""
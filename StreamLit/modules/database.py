@@ -1,9 +1,11 @@
 import os
+import weakref
 from sqlalchemy import (create_engine, Column, Integer, String, Boolean, Text,
                         ForeignKey, UniqueConstraint)
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 # Define the base class for declarative models
 Base = declarative_base()
@@ -138,15 +140,31 @@ class Note(Base):
     patient = relationship("Patient", back_populates="notes")
 
 
-def get_db_engine(db_path: str, key: str | None = None) -> Engine:
+def get_db_engine(db_path: str, key: str | None = None, pool_size: int | None = None,
+                  bulk_import: bool = False) -> Engine:
     """
     Creates a SQLAlchemy engine for the given database path.
     If the directory for the db_path doesn't exist, it will be created.
+    `pool_size` gives long-lived (cached) engines a fixed pool of reused connections.
+    `bulk_import` tunes the engine for DataImporter's batched transactions (see below);
+    other engines keep pysqlite's default transaction handling.
     """
     db_dir = os.path.dirname(db_path)
     if db_dir and not os.path.exists(db_dir):
         os.makedirs(db_dir)
-    engine = create_engine(f'sqlite:///{db_path}')
+    pool_args = {}
+    if pool_size:
+        # Pooled connections skip the per-checkout PRAGMA/key setup; pre_ping drops stale ones.
+        # No overflow: SQLite has a single writer, extra handles would only wait on it.
+        pool_args = dict(
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=0,
+            pool_timeout=30,
+            pool_pre_ping=True,
+            connect_args={"check_same_thread": False},
+        )
+    engine = create_engine(f'sqlite:///{db_path}', **pool_args)
     if key:
         # Attempt to enable SQLCipher; requires sqlite built with SQLCipher
         @event.listens_for(engine, "connect")
@@ -160,17 +178,85 @@ def get_db_engine(db_path: str, key: str | None = None) -> Engine:
                 pass
             finally:
                 cursor.close()
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            # Memory-mapped reads for the explorer's scans (SQLCipher ignores this)
+            cursor.execute("PRAGMA mmap_size=268435456;")
+        except Exception:
+            pass
+        finally:
+            cursor.close()
+
+    if bulk_import:
+        @event.listens_for(engine, "connect")
+        def set_import_pragmas(dbapi_connection, connection_record):
+            # Let SQLAlchemy emit BEGIN itself; pysqlite's implicit transactions break SAVEPOINT
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            try:
+                # WAL: readers don't block imports, and commits only fsync at checkpoints.
+                # The journal mode is stored in the file, so it stays WAL after the first import.
+                cursor.execute("PRAGMA journal_mode=WAL;")
+                cursor.execute("PRAGMA synchronous=NORMAL;")
+                cursor.execute("PRAGMA temp_store=MEMORY;")
+            except Exception:
+                pass
+            finally:
+                cursor.close()
+
+        @event.listens_for(engine, "begin")
+        def do_begin(conn):
+            conn.exec_driver_sql("BEGIN")
+
     return engine
 
 def setup_database(engine: Engine):
     """
     Creates all tables in the database.
+    When every table already exists (one sqlite_master query) the DDL is skipped.
     """
+    names = list(Base.metadata.tables)
+    placeholders = ", ".join("?" * len(names))
+    with engine.connect() as conn:
+        found = conn.exec_driver_sql(
+            f"SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN ({placeholders})",
+            tuple(names),
+        ).scalar()
+    if found == len(names):
+        return
     Base.metadata.create_all(engine)
 
+def compact_after_import(engine: Engine):
+    """
+    Folds the WAL back into the database file and refreshes planner statistics.
+    Best-effort: a checkpoint blocked by an open reader is simply skipped.
+    """
+    # Raw DBAPI connection: no SQLAlchemy BEGIN, since wal_checkpoint can't run inside a transaction
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        try:
+            cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            cursor.fetchall()
+            cursor.execute("PRAGMA optimize;")
+        except Exception:
+            pass
+        finally:
+            cursor.close()
+    finally:
+        raw.close()
+
+# One sessionmaker per engine; entries go away with their engine
+_session_factories: "weakref.WeakKeyDictionary[Engine, sessionmaker]" = weakref.WeakKeyDictionary()
+
 def get_session(engine: Engine):
     """
     Creates a new SQLAlchemy session.
     """
-    Session = sessionmaker(bind=engine)
+    Session = _session_factories.get(engine)
+    if Session is None:
+        Session = _session_factories[engine] = sessionmaker(bind=engine)
     return Session()
@@ -0,0 +1,35 @@
+"""Process-wide SQLAlchemy engines for the Streamlit pages.
+
+Kept apart from `database` so the models (and the importer's worker processes)
+don't depend on Streamlit.
+"""
+import hashlib
+
+import streamlit as st
+from sqlalchemy.engine import Engine
+
+from .database import get_db_engine
+
+
+# Connections kept open per cached engine
+_POOL_SIZE = 5
+
+
+def key_fingerprint(key: str | None) -> str:
+    """Short, non-reversible fingerprint of the encryption key for use in cache keys."""
+    return hashlib.sha256(str(key or "").encode("utf-8")).hexdigest()[:16]
+
+
+@st.cache_resource(show_spinner=False)
+def _cached_engine(db_path: str, key_fp: str, _key: str | None, bulk_import: bool = False) -> Engine:
+    return get_db_engine(db_path, key=_key, pool_size=_POOL_SIZE, bulk_import=bulk_import)
+
+
+def get_cached_engine(db_path: str, key: str | None = None, bulk_import: bool = False) -> Engine:
+    """
+    Returns a process-wide engine for (db_path, key), reused across reruns and pages.
+    The key is only hashed into the cache key, never stored in it.
+    `bulk_import=True` returns the separate engine tuned for DataImporter.
+    Call `.dispose()` on both before deleting or replacing the database file.
+    """
+    return _cached_engine(db_path, key_fingerprint(key), key, bulk_import)
@@ -13,12 +13,38 @@ from __future__ import annotations
 
 import base64
 import hashlib
+import http.cookiejar
 import os
+import threading
 import time
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+# Keep-alive connections for FHIR reads: consecutive pages and Binary GETs on a thread
+# reuse TLS connections. One Session per thread, since requests.Session isn't
+# guaranteed thread-safe and user sessions/fetch pools all run as threads.
+_local = threading.local()
+
+
+class _NoCookies(http.cookiejar.DefaultCookiePolicy):
+    """Never store cookies: FHIR reads are bearer-token authenticated."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+def _http() -> requests.Session:
+    sess = getattr(_local, "session", None)
+    if sess is None:
+        sess = requests.Session()
+        sess.cookies.set_policy(_NoCookies())
+        sess.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+        sess.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+        _local.session = sess
+    return sess
 
 
 @dataclass
@@ -131,7 +157,7 @@ def _auth_header(tokens: OAuthTokens) -> Dict[str, str]:
 
 
 def get_json(url: str, tokens: OAuthTokens, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-    resp = requests.get(url, headers=_auth_header(tokens), params=params or {}, timeout=30)
+    resp = _http().get(url, headers=_auth_header(tokens), params=params or {}, timeout=30)
     if not resp.ok:
         # Try to surface FHIR OperationOutcome or JSON error details
         try:
@@ -200,12 +226,12 @@ def fetch_binary(base_url: str, tokens: OAuthTokens, binary_id: str) -> bytes:
     base = base_url.rstrip('/')
     url = f"{base}/Binary/{binary_id}"
     headers_raw = {"Authorization": f"{tokens.token_type} {tokens.access_token}", "Accept": "*/*"}
-    resp = requests.get(url, headers=headers_raw, timeout=60)
+    resp = _http().get(url, headers=headers_raw, timeout=60)
     print(f'Fetching Binary resource from URL: {url}')
     print(f'Response status code: {resp.status_code}')
     if resp.status_code in (403, 404):
         alt = f"{url}/$binary"
-        resp2 = requests.get(alt, headers=headers_raw, timeout=60)
+        resp2 = _http().get(alt, headers=headers_raw, timeout=60)
         resp2.raise_for_status()
         return resp2.content
     resp.raise_for_status()
@@ -222,7 +248,7 @@ def fetch_binary(base_url: str, tokens: OAuthTokens, binary_id: str) -> bytes:
                 return base64.b64decode(data_b64)
             # No inline data found; try $binary endpoint as a fallback
             alt = f"{url}/$binary"
-            resp2 = requests.get(alt, headers=headers_raw, timeout=60)
+            resp2 = _http().get(alt, headers=headers_raw, timeout=60)
             resp2.raise_for_status()
             return resp2.content
         except ValueError:
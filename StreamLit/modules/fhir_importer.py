@@ -8,6 +8,7 @@ from __future__ import annotations
 
 from typing import Any, Dict, List, Optional, Tuple
 import hashlib
+from itertools import chain
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
@@ -139,6 +140,75 @@ def _bytes_to_note_text(raw: bytes, content_type: Optional[str]) -> Optional[str
     except Exception:
         return None
 
+def _binary_id(url: str) -> Optional[str]:
+    """Binary id from Binary/{id} or an absolute URL containing /Binary/{id} (with optional /$binary)."""
+    if url.startswith("Binary/"):
+        return url.split("/", 1)[1]
+    try:
+        import re
+        m = re.search(r"/Binary/([^/?#]+)", url)
+        if m:
+            return m.group(1)
+    except Exception:
+        pass
+    return None
+
+
+def _attachments(res: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Attachments of a DocumentReference (content[]) or DiagnosticReport (presentedForm)."""
+    atts = [c.get("attachment") or {} for c in (res.get("content") or [])]
+    atts.extend(res.get("presentedForm") or [])
+    return atts
+
+
+def prefetch_binaries(resources: List[Dict[str, Any]], binary_loader, max_workers: int = 8, on_progress=None):
+    """Fetch the Binary attachments the ingesters will ask for, concurrently.
+
+    Only the first usable attachment of each resource is prefetched, since
+    _extract_note_text stops there when it succeeds. Returns a loader that
+    serves prefetched bytes (re-raising a failed fetch's error) and falls
+    back to binary_loader for anything else. `on_progress(done, total)` is
+    called on the caller's thread as fetches complete.
+    """
+    bids: List[str] = []
+    for res in resources:
+        for att in _attachments(res):
+            if att.get("data"):
+                break
+            bid = _binary_id(att.get("url") or "")
+            if bid:
+                bids.append(bid)
+                break
+    bids = list(dict.fromkeys(bids))
+    if not bids:
+        return binary_loader
+
+    def _fetch(bid: str):
+        try:
+            return True, binary_loader(bid)
+        except Exception as e:
+            return False, e
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    cache: Dict[str, Tuple[bool, Any]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {ex.submit(_fetch, bid): bid for bid in bids}
+        for done, fut in enumerate(as_completed(futures), 1):
+            cache[futures[fut]] = fut.result()
+            if on_progress is not None:
+                on_progress(done, len(bids))
+
+    def _loader(bid: str) -> bytes:
+        hit = cache.get(bid)
+        if hit is None:
+            return binary_loader(bid)
+        ok, val = hit
+        if not ok:
+            raise val
+        return val
+    return _loader
+
+
 def _extract_note_text(doc: Dict[str, Any], binary_loader) -> Tuple[Optional[str], Optional[str]]:
     """Return (content_text, content_type). Supports:
     - content[].attachment.data (base64)
@@ -168,18 +238,7 @@ def _extract_note_text(doc: Dict[str, Any], binary_loader) -> Tuple[Optional[str
                 continue
         url = att.get("url")
         if url:
-            # Support Binary/{id} or absolute URLs that contain /Binary/{id} (with optional /$binary)
-            bid: Optional[str] = None
-            if url.startswith("Binary/"):
-                bid = url.split("/", 1)[1]
-            else:
-                try:
-                    import re
-                    m = re.search(r"/Binary/([^/?#]+)", url)
-                    if m:
-                        bid = m.group(1)
-                except Exception:
-                    bid = None
+            bid = _binary_id(url)
             if bid:
                 try:
                     data = binary_loader(bid)
@@ -211,7 +270,8 @@ def ingest_document_references(engine: Engine, docs: List[Dict[str, Any]], binar
             patient = Patient(mrn=None, full_name=None, dob=None)
             session.add(patient)
             session.flush()
-        new_count = 0
+        seen = _existing_keys(session, Note, patient.id, "note_date", "note_title")
+        rows: List[Dict[str, Any]] = []
         skipped_no_content = 0
         for doc in docs:
             base_title = _docref_title(doc) or "Clinical Note"
@@ -223,10 +283,7 @@ def ingest_document_references(engine: Engine, docs: List[Dict[str, Any]], binar
                 continue
             # Primary check: (patient_id, date, title)
             title = base_title
-            exists = session.query(Note).filter_by(
-                patient_id=patient.id, note_date=date, note_title=title
-            ).first()
-            if exists:
+            if (date, title) in seen:
                 # Disambiguate with DocumentReference.id or content hash
                 doc_id = doc.get("id")
                 if isinstance(doc_id, str) and doc_id:
@@ -234,24 +291,20 @@ def ingest_document_references(engine: Engine, docs: List[Dict[str, Any]], binar
                 else:
                     digest = hashlib.sha1(content_text.encode("utf-8", errors="replace")).hexdigest()[:8]
                     title = f"{base_title} [H:{digest}]"
-                exists2 = session.query(Note).filter_by(
-                    patient_id=patient.id, note_date=date, note_title=title
-                ).first()
-                if exists2:
+                if (date, title) in seen:
                     # Consider true duplicate; skip
                     continue
 
-            note = Note(
+            seen.add((date, title))
+            rows.append(dict(
                 patient_id=patient.id,
                 note_type="FHIR DocumentReference",
                 note_date=date,
                 note_title=title,
                 note_content=content_text,
                 provider=provider,
-            )
-
-            session.add(note)
-            new_count += 1
+            ))
+        new_count = _bulk_insert(session, Note, rows)
         session.commit()
         if skipped_no_content:
             try:
@@ -269,6 +322,27 @@ def ingest_document_references(engine: Engine, docs: List[Dict[str, Any]], binar
 
 # ---------------- Additional ingesters for DB schema ---------------- #
 
+# Rows per executemany() batch when inserting new records
+_INSERT_CHUNK = 500
+# Rows fetched per batch when scanning existing keys
+_SCAN_BATCH = 1000
+
+
+def _existing_keys(session: Session, model, patient_id: int, *cols: str) -> set:
+    """Dedup keys already stored for the patient: one query instead of one per item.
+
+    Rows are streamed in batches so only the key set, not the result list, is held.
+    """
+    q = session.query(*[getattr(model, c) for c in cols]).filter(model.patient_id == patient_id)
+    return {tuple(r) for r in q.yield_per(_SCAN_BATCH)}
+
+
+def _bulk_insert(session: Session, model, rows: List[Dict[str, Any]]) -> int:
+    """Insert plain row dicts with chunked executemany (no ORM object per row)."""
+    for i in range(0, len(rows), _INSERT_CHUNK):
+        session.execute(model.__table__.insert(), rows[i:i + _INSERT_CHUNK])
+    return len(rows)
+
 def _code_text(d: Optional[Dict[str, Any]]) -> Optional[str]:
     if not d:
         return None
@@ -345,7 +419,8 @@ def ingest_allergies(engine: Engine, items: List[Dict[str, Any]]) -> int:
     session = get_session(engine)
     try:
         pat = _patient_row(session) or upsert_patient(engine, None)
-        new = 0
+        seen = _existing_keys(session, Allergy, pat.id, "substance", "effective_date")
+        rows: List[Dict[str, Any]] = []
         for it in items:
             substance = _code_text(it.get("code"))
             # Choose first manifestation if present
@@ -360,18 +435,17 @@ def ingest_allergies(engine: Engine, items: List[Dict[str, Any]]) -> int:
             # Guard: require minimal identifying fields to avoid blank rows
             if not substance or not effective:
                 continue
-            exists = session.query(Allergy).filter_by(patient_id=pat.id, substance=substance, effective_date=effective).first()
-            if exists:
+            if (substance, effective) in seen:
                 continue
-            row = Allergy(
+            seen.add((substance, effective))
+            rows.append(dict(
                 patient_id=pat.id,
                 substance=substance,
                 reaction=reaction,
                 status=status,
                 effective_date=effective,
-            )
-            session.add(row)
-            new += 1
+            ))
+        new = _bulk_insert(session, Allergy, rows)
         session.commit()
         return new
     finally:
@@ -383,7 +457,8 @@ def ingest_conditions(engine: Engine, items: List[Dict[str, Any]]) -> int:
     session = get_session(engine)
     try:
         pat = _patient_row(session) or upsert_patient(engine, None)
-        new = 0
+        seen = _existing_keys(session, Problem, pat.id, "problem_name", "onset_date")
+        rows: List[Dict[str, Any]] = []
         for it in items:
             name = _code_text(it.get("code"))
             status = _code_text(it.get("clinicalStatus"))
@@ -392,30 +467,30 @@ def ingest_conditions(engine: Engine, items: List[Dict[str, Any]]) -> int:
             # Guard: require name and onset for deduplication; skip otherwise
             if not name or not onset:
                 continue
-            exists = session.query(Problem).filter_by(patient_id=pat.id, problem_name=name, onset_date=onset).first()
-            if exists:
+            if (name, onset) in seen:
                 continue
-            row = Problem(
+            seen.add((name, onset))
+            rows.append(dict(
                 patient_id=pat.id,
                 problem_name=name,
                 status=status,
                 onset_date=onset,
                 resolved_date=resolved,
-            )
-            session.add(row)
-            new += 1
+            ))
+        new = _bulk_insert(session, Problem, rows)
         session.commit()
         return new
     finally:
         session.close()
 
 
-def ingest_medications(engine: Engine, statements: List[Dict[str, Any]], requests: List[Dict[str, Any]]) -> int:
+def ingest_medications(engine: Engine, statements: List[Dict[str, Any]], med_requests: List[Dict[str, Any]]) -> int:
     from .database import Medication
     session = get_session(engine)
     try:
         pat = _patient_row(session) or upsert_patient(engine, None)
-        new = 0
+        seen = _existing_keys(session, Medication, pat.id, "medication_name", "start_date")
+        rows: List[Dict[str, Any]] = []
 
         def _med_fields(m: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
             name = _code_text(m.get("medicationCodeableConcept"))
@@ -429,29 +504,18 @@ def ingest_medications(engine: Engine, statements: List[Dict[str, Any]], request
             end = (m.get("effectivePeriod") or {}).get("end")
             return name, instr, status, start if start else None, end if end else None  # type: ignore
 
-        for it in statements:
+        # Statements first, then requests: the first occurrence of a (name, start) wins
+        for it in chain(statements, med_requests):
             name, instr, status, start, end = _med_fields(it)
             # Guard: require name and start date
             if not name or not start:
                 continue
-            exists = session.query(Medication).filter_by(patient_id=pat.id, medication_name=name, start_date=start).first()
-            if exists:
-                continue
-            row = Medication(patient_id=pat.id, medication_name=name, instructions=instr, status=status, start_date=start, end_date=end)
-            session.add(row)
-            new += 1
-
-        for it in requests:
-            name, instr, status, start, end = _med_fields(it)
-            if not name or not start:
-                continue
-            exists = session.query(Medication).filter_by(patient_id=pat.id, medication_name=name, start_date=start).first()
-            if exists:
+            if (name, start) in seen:
                 continue
-            row = Medication(patient_id=pat.id, medication_name=name, instructions=instr, status=status, start_date=start, end_date=end)
-            session.add(row)
-            new += 1
+            seen.add((name, start))
+            rows.append(dict(patient_id=pat.id, medication_name=name, instructions=instr, status=status, start_date=start, end_date=end))
 
+        new = _bulk_insert(session, Medication, rows)
         session.commit()
         return new
     finally:
@@ -463,19 +527,19 @@ def ingest_immunizations(engine: Engine, items: List[Dict[str, Any]]) -> int:
     session = get_session(engine)
     try:
         pat = _patient_row(session) or upsert_patient(engine, None)
-        new = 0
+        seen = _existing_keys(session, Imm, pat.id, "vaccine_name", "date_administered")
+        rows: List[Dict[str, Any]] = []
         for it in items:
             name = _code_text(it.get("vaccineCode"))
             date = it.get("occurrenceDateTime") or it.get("occurrenceString")
             # Guard: require vaccine name and date
             if not name or not date:
                 continue
-            exists = session.query(Imm).filter_by(patient_id=pat.id, vaccine_name=name, date_administered=date).first()
-            if exists:
+            if (name, date) in seen:
                 continue
-            row = Imm(patient_id=pat.id, vaccine_name=name, date_administered=date)
-            session.add(row)
-            new += 1
+            seen.add((name, date))
+            rows.append(dict(patient_id=pat.id, vaccine_name=name, date_administered=date))
+        new = _bulk_insert(session, Imm, rows)
         session.commit()
         return new
     finally:
@@ -488,8 +552,16 @@ def ingest_observations(engine: Engine, items: List[Dict[str, Any]]) -> Tuple[in
     session = get_session(engine)
     try:
         pat = _patient_row(session) or upsert_patient(engine, None)
-        nv = 0
-        nr = 0
+        seen_vitals = _existing_keys(session, Vital, pat.id, "vital_sign", "effective_date")
+        seen_results = _existing_keys(session, Result, pat.id, "test_name", "effective_date")
+        vitals: List[Dict[str, Any]] = []
+        results: List[Dict[str, Any]] = []
+
+        def _add_result(test_name: str, eff: str, value, unit, interpretation=None) -> None:
+            if (test_name, eff) in seen_results:
+                return
+            seen_results.add((test_name, eff))
+            results.append(dict(patient_id=pat.id, test_name=test_name, effective_date=eff, value=value, unit=unit, reference_range=None, interpretation=interpretation))
 
         def _obs_category(o: Dict[str, Any]) -> List[str]:
             cats: List[str] = []
@@ -525,48 +597,32 @@ def ingest_observations(engine: Engine, items: List[Dict[str, Any]]) -> Tuple[in
 
             if "vital-signs" in cats:
                 val, unit = _value(o)
-                if val is not None:
-                    exists = session.query(Vital).filter_by(patient_id=pat.id, vital_sign=code_name, effective_date=eff).first()
-                    if not exists:
-                        row = Vital(patient_id=pat.id, vital_sign=code_name, value=val, unit=unit, effective_date=eff)
-                        session.add(row)
-                        nv += 1
+                if val is not None and (code_name, eff) not in seen_vitals:
+                    seen_vitals.add((code_name, eff))
+                    vitals.append(dict(patient_id=pat.id, vital_sign=code_name, value=val, unit=unit, effective_date=eff))
             elif "laboratory" in cats or "lab" in cats:
                 val, unit = _value(o)
                 if val is not None:
-                    exists = session.query(Result).filter_by(patient_id=pat.id, test_name=code_name, effective_date=eff).first()
-                    if not exists:
-                        row = Result(
-                            patient_id=pat.id,
-                            test_name=code_name,
-                            effective_date=eff,
-                            value=val,
-                            unit=unit,
-                            reference_range=None,
-                            interpretation=_code_text((o.get("interpretation") or [{}])[0]) if isinstance(o.get("interpretation"), list) else _code_text(o.get("interpretation")),
-                        )
-                        session.add(row)
-                        nr += 1
+                    _add_result(
+                        code_name,
+                        eff,
+                        val,
+                        unit,
+                        interpretation=_code_text((o.get("interpretation") or [{}])[0]) if isinstance(o.get("interpretation"), list) else _code_text(o.get("interpretation")),
+                    )
                 # Components as separate result rows
                 for comp in components:
                     cname = _code_text(comp.get("code"))
                     cval, cunit = _value(comp)
                     if cname and cval is not None:
-                        full_name = f"{code_name}: {cname}"
-                        exists = session.query(Result).filter_by(patient_id=pat.id, test_name=full_name, effective_date=eff).first()
-                        if not exists:
-                            row = Result(patient_id=pat.id, test_name=full_name, effective_date=eff, value=cval, unit=cunit, reference_range=None, interpretation=None)
-                            session.add(row)
-                            nr += 1
+                        _add_result(f"{code_name}: {cname}", eff, cval, cunit)
             else:
                 # Unknown category: attempt to store as results
                 val, unit = _value(o)
                 if val is not None:
-                    exists = session.query(Result).filter_by(patient_id=pat.id, test_name=code_name, effective_date=eff).first()
-                    if not exists:
-                        row = Result(patient_id=pat.id, test_name=code_name, effective_date=eff, value=val, unit=unit, reference_range=None, interpretation=None)
-                        session.add(row)
-                        nr += 1
+                    _add_result(code_name, eff, val, unit)
+        nv = _bulk_insert(session, Vital, vitals)
+        nr = _bulk_insert(session, Result, results)
         session.commit()
         return nv, nr
     finally:
@@ -578,7 +634,8 @@ def ingest_procedures(engine: Engine, items: List[Dict[str, Any]]) -> int:
     session = get_session(engine)
     try:
         pat = _patient_row(session) or upsert_patient(engine, None)
-        new = 0
+        seen = _existing_keys(session, Procedure, pat.id, "procedure_name", "date")
+        rows: List[Dict[str, Any]] = []
         for it in items:
             name = _code_text(it.get("code"))
             date = it.get("performedDateTime") or ((it.get("performedPeriod") or {}).get("start"))
@@ -590,12 +647,11 @@ def ingest_procedures(engine: Engine, items: List[Dict[str, Any]]) -> int:
             # Guard: require name and date
             if not name or not date:
                 continue
-            exists = session.query(Procedure).filter_by(patient_id=pat.id, procedure_name=name, date=date).first()
-            if exists:
+            if (name, date) in seen:
                 continue
-            row = Procedure(patient_id=pat.id, procedure_name=name, date=date, provider=provider)
-            session.add(row)
-            new += 1
+            seen.add((name, date))
+            rows.append(dict(patient_id=pat.id, procedure_name=name, date=date, provider=provider))
+        new = _bulk_insert(session, Procedure, rows)
         session.commit()
         return new
     finally:
@@ -607,12 +663,13 @@ def ingest_diagnostic_reports_as_notes(engine: Engine, reports: List[Dict[str, A
 
     Returns (new_rows, skipped_no_content).
     """
-    new_total = 0
     skipped_total = 0
     # Convert each DR into a pseudo-DocumentReference-like structure and reuse _extract_note_text
     session = get_session(engine)
     try:
         pat = _patient_row(session) or upsert_patient(engine, None)
+        seen = _existing_keys(session, Note, pat.id, "note_date", "note_title")
+        rows: List[Dict[str, Any]] = []
         for dr in reports:
             presented = dr.get("presentedForm") or []
             if not presented:
@@ -635,20 +692,18 @@ def ingest_diagnostic_reports_as_notes(engine: Engine, reports: List[Dict[str, A
                 continue
             # Deduplicate using same logic as DocumentReference
             title_base = title
-            exists = session.query(Note).filter_by(patient_id=pat.id, note_date=date, note_title=title_base).first()
-            if exists:
+            if (date, title_base) in seen:
                 drid = dr.get("id")
                 if isinstance(drid, str) and drid:
                     title = f"{title_base} [DR:{drid}]"
                 else:
                     digest = hashlib.sha1(content_text.encode("utf-8", errors="replace")).hexdigest()[:8]
                     title = f"{title_base} [H:{digest}]"
-                exists2 = session.query(Note).filter_by(patient_id=pat.id, note_date=date, note_title=title).first()
-                if exists2:
+                if (date, title) in seen:
                     continue
-            note = Note(patient_id=pat.id, note_type="FHIR DiagnosticReport", note_date=date, note_title=title, note_content=content_text, provider=provider)
-            session.add(note)
-            new_total += 1
+            seen.add((date, title))
+            rows.append(dict(patient_id=pat.id, note_type="FHIR DiagnosticReport", note_date=date, note_title=title, note_content=content_text, provider=provider))
+        new_total = _bulk_insert(session, Note, rows)
         session.commit()
         return new_total, skipped_total
     finally:
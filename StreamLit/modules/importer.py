@@ -1,12 +1,48 @@
 import logging
 import os
-from bs4 import BeautifulSoup
+from contextlib import contextmanager
+from bs4 import BeautifulSoup, SoupStrainer
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from .database import (
     Patient, Allergy, Problem, Medication, Immunization, Vital, Result, Procedure, Note, get_session
 )
 
+# Record types produced by the parser, by name (records cross process boundaries as plain data)
+_MODELS = {m.__name__: m for m in (Allergy, Problem, Medication, Immunization, Vital, Result, Procedure, Note)}
+
+# SQLite page cache while a bulk import transaction is open (negative = KiB, i.e. 64 MiB)
+_BULK_CACHE_SIZE = -65536
+
+# CDA sections: (label, templateId root, ingestor method)
+_SECTION_INGESTORS = (
+    ("Allergies", "2.16.840.1.113883.10.20.22.2.6.1", "_ingest_allergies"),
+    ("Problems", "2.16.840.1.113883.10.20.22.2.5.1", "_ingest_problems"),
+    ("Medications", "2.16.840.1.113883.10.20.22.2.1.1", "_ingest_medications"),
+    ("Immunizations", "2.16.840.1.113883.10.20.22.2.2.1", "_ingest_immunizations"),
+    ("Vitals", "2.16.840.1.113883.10.20.22.2.4.1", "_ingest_vitals"),
+    ("Results", "2.16.840.1.113883.10.20.22.2.3.1", "_ingest_results"),
+    ("Procedures", "2.16.840.1.113883.10.20.22.2.7.1", "_ingest_procedures"),
+    ("Clinical Notes", "1.3.6.1.4.1.19376.1.5.3.1.3.4", "_ingest_notes"),
+)
+
+
+# Only these subtrees are built; the rest of the CDA header (authors, custodian,
+# participants, ...) is skipped while parsing. Every top-level effectiveTime is
+# kept so the note-date fallback still finds the document's first one.
+_PARSE_ONLY = SoupStrainer(["recordTarget", "componentOf", "section", "effectiveTime"])
+
+
+def parse_xml_to_records(content) -> dict | None:
+    """Parse one CDA document into plain, picklable records without touching the database.
+
+    Returns {"patient": {...}, "records": [(model_name, match, values), ...]}, or None if
+    the document has no patient. Safe to run in a worker process; pass the result to
+    DataImporter.insert_records.
+    """
+    return DataImporter(None).parse_xml(content)
+
+
 class DataImporter:
     """
     Handles the core logic of parsing XML files and inserting data into the database using SQLAlchemy.
@@ -15,53 +51,149 @@ class DataImporter:
         # Store engine; create a fresh session per file import
         self.engine = db_engine
         self.session = None
+        # Records collected by the ingestors while parsing one document
+        self._records = None
+        # True inside transaction(): documents share one session and commit once
+        self._in_transaction = False
 
     def process_xml_file(self, xml_file: str):
         """Main processing function for a single XML file."""
-        try:
-            # Create a fresh session per file, so multiple files import cleanly
-            self.session = get_session(self.engine)
-            with open(xml_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            soup = BeautifulSoup(content, 'lxml-xml')
+        with open(xml_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        self._process_xml_content(content, os.path.basename(xml_file))
 
-            patient = self._ingest_patient(soup)
-            if patient is None:
-                logging.error(f"Could not find/create patient in {os.path.basename(xml_file)}. Skipping.")
+    def process_xml_stream(self, fileobj, name: str = "<stream>"):
+        """Process an XML document from a file-like object (e.g. a Streamlit UploadedFile).
+
+        The bytes are handed straight to the parser, which honours the XML
+        declaration's encoding; no temporary file is written.
+        """
+        self._process_xml_content(fileobj.read(), name)
+
+    def _process_xml_content(self, content, name: str):
+        try:
+            parsed = self.parse_xml(content)
+            if parsed is None:
+                logging.error(f"Could not find/create patient in {name}. Skipping.")
                 return
+            self.insert_records(parsed)
+        except Exception as e:
+            logging.error(f"An unexpected error occurred with {name}: {e}", exc_info=True)
 
-            section_ingestors = {
-                "Allergies": ("2.16.840.1.113883.10.20.22.2.6.1", self._ingest_allergies),
-                "Problems": ("2.16.840.1.113883.10.20.22.2.5.1", self._ingest_problems),
-                "Medications": ("2.16.840.1.113883.10.20.22.2.1.1", self._ingest_medications),
-                "Immunizations": ("2.16.840.1.113883.10.20.22.2.2.1", self._ingest_immunizations),
-                "Vitals": ("2.16.840.1.113883.10.20.22.2.4.1", self._ingest_vitals),
-                "Results": ("2.16.840.1.113883.10.20.22.2.3.1", self._ingest_results),
-                "Procedures": ("2.16.840.1.113883.10.20.22.2.7.1", self._ingest_procedures),
-                "Clinical Notes": ("1.3.6.1.4.1.19376.1.5.3.1.3.4", self._ingest_notes),
-            }
-
-            for name, (template_id, func) in section_ingestors.items():
-                sections = soup.select(f'section:has(templateId[root="{template_id}"])')
-                if not sections:
-                    continue
-                
-                total_count = sum(func(soup, section, patient) for section in sections)
-                if total_count > 0:
-                    logging.info(f"  > Found {total_count} new record(s) in {name}.")
-            
+    def parse_xml(self, content) -> dict | None:
+        """Parse a CDA document into records; see `parse_xml_to_records`."""
+        soup = BeautifulSoup(content, 'lxml-xml', parse_only=_PARSE_ONLY)
+        patient = self._parse_patient(soup)
+        if patient is None:
+            return None
+        # One walk over the sections, bucketed by the templateIds they contain
+        # (same matches, in document order, as `section:has(templateId[root=...])`
+        # but without re-scanning every section once per section type)
+        by_template = {template_id: [] for _label, template_id, _method in _SECTION_INGESTORS}
+        for section in soup.find_all('section'):
+            roots = {t.get('root') for t in section.find_all('templateId')}
+            for template_id in roots.intersection(by_template):
+                by_template[template_id].append(section)
+        self._records = []
+        try:
+            for _label, template_id, method in _SECTION_INGESTORS:
+                ingest = getattr(self, method)
+                for section in by_template[template_id]:
+                    ingest(soup, section)
+            return {"patient": patient, "records": self._records}
+        finally:
+            self._records = None
+
+    @contextmanager
+    def transaction(self):
+        """Import several documents in one transaction, committed once on exit.
+
+        Each document is written under its own SAVEPOINT, so a failing one is rolled
+        back without losing the others. The connection's page cache is enlarged for
+        the duration and restored before it goes back to the pool. Needs an engine
+        created with `bulk_import=True`, whose connections support SAVEPOINT.
+        """
+        self.session = get_session(self.engine)
+        self._in_transaction = True
+        conn = prev_cache = None
+        try:
+            conn = self.session.connection()
+            prev_cache = conn.exec_driver_sql("PRAGMA cache_size").scalar()
+            conn.exec_driver_sql(f"PRAGMA cache_size={_BULK_CACHE_SIZE}")
+            yield self
+            conn.exec_driver_sql(f"PRAGMA cache_size={int(prev_cache)}")
             self.session.commit()
+        except Exception:
+            if prev_cache is not None:
+                try:
+                    conn.exec_driver_sql(f"PRAGMA cache_size={int(prev_cache)}")
+                except Exception:
+                    pass
+            self.session.rollback()
+            raise
+        finally:
+            self._in_transaction = False
+            self.session.close()
+            self.session = None
 
-        except Exception as e:
-            logging.error(f"An unexpected error occurred with {os.path.basename(xml_file)}: {e}", exc_info=True)
+    def database_size_bytes(self) -> int:
+        """Logical database size (page_count * page_size).
+
+        Inside transaction() this is read on the importing connection, so pages
+        written but not yet committed (not yet in the file or its WAL) are counted.
+        """
+        def _size(conn) -> int:
+            pages = conn.exec_driver_sql("PRAGMA page_count").scalar() or 0
+            page_size = conn.exec_driver_sql("PRAGMA page_size").scalar() or 0
+            return int(pages) * int(page_size)
+
+        if self.session is not None:
+            return _size(self.session.connection())
+        with self.engine.connect() as conn:
+            return _size(conn)
+
+    def insert_records(self, parsed: dict) -> int:
+        """Write parsed records in one session/transaction, skipping rows that already exist.
+
+        Duplicates are detected per record against the database (and earlier records of
+        the same document, via autoflush). Returns the number of new rows.
+        """
+        if self._in_transaction:
+            with self.session.begin_nested():
+                return self._insert_parsed(parsed)
+        try:
+            # Create a fresh session per file, so multiple files import cleanly
+            self.session = get_session(self.engine)
+            count = self._insert_parsed(parsed)
+            self.session.commit()
+            return count
+        except Exception:
             if self.session is not None:
                 self.session.rollback()
+            raise
         finally:
             if self.session is not None:
                 self.session.close()
                 self.session = None
 
+    def _insert_parsed(self, parsed: dict) -> int:
+        patient = self._get_or_create_patient(parsed["patient"])
+        new_counts = {}
+        for model_name, match, values in parsed.get("records") or []:
+            model = _MODELS[model_name]
+            if self.session.query(model).filter_by(patient_id=patient.id, **match).first():
+                continue
+            self.session.add(model(patient_id=patient.id, **values))
+            new_counts[model_name] = new_counts.get(model_name, 0) + 1
+        self.session.flush()
+        for model_name, n in new_counts.items():
+            logging.info(f"  > Found {n} new {model_name} record(s).")
+        return sum(new_counts.values())
+
+    def _add_record(self, model, match: dict, values: dict):
+        """Queue a row for insertion; `match` holds the columns used to detect duplicates."""
+        self._records.append((model.__name__, match, values))
+
     def _find_text(self, element, tag_name):
         """Find text using a CSS selector or simple tag name; supports nested paths."""
         if element is None:
@@ -128,7 +260,7 @@ class DataImporter:
                         return referenced_el.get_text(strip=True)
         return None
 
-    def _ingest_patient(self, soup):
+    def _parse_patient(self, soup):
         patient_role = soup.select_one('recordTarget > patientRole')
         if not patient_role: return None
         
@@ -136,28 +268,30 @@ class DataImporter:
         given_name = self._find_text(patient_el, "given") or ""
         family_name = self._find_text(patient_el, "family") or ""
         full_name = f"{given_name} {family_name}".strip()
-        dob = self._find_attrib(patient_el, 'birthTime', 'value')
-        mrn = self._find_attrib(patient_role, "id", "extension")
-
-        patient = self.session.query(Patient).filter_by(mrn=mrn, full_name=full_name, dob=dob).first()
-        if patient:
-            return patient
-        
-        new_patient = Patient(
-            mrn=mrn, full_name=full_name, dob=dob,
+        return dict(
+            mrn=self._find_attrib(patient_role, "id", "extension"),
+            full_name=full_name,
+            dob=self._find_attrib(patient_el, 'birthTime', 'value'),
             gender=self._find_attrib(patient_el, 'administrativeGenderCode', 'displayName'),
             marital_status=self._find_attrib(patient_el, 'maritalStatusCode', 'displayName'),
             race=self._find_attrib(patient_el, 'raceCode', 'displayName'),
             ethnicity=self._find_attrib(patient_el, 'ethnicGroupCode', 'displayName'),
             deceased=self._find_attrib(patient_el, 'sdtc:deceasedInd', 'value') == 'true',
-            deceased_date=self._find_attrib(patient_el, 'sdtc:deceasedTime', 'value')
+            deceased_date=self._find_attrib(patient_el, 'sdtc:deceasedTime', 'value'),
         )
+
+    def _get_or_create_patient(self, fields: dict):
+        patient = self.session.query(Patient).filter_by(
+            mrn=fields.get('mrn'), full_name=fields.get('full_name'), dob=fields.get('dob')
+        ).first()
+        if patient:
+            return patient
+        new_patient = Patient(**fields)
         self.session.add(new_patient)
         self.session.flush() # Use flush to get the ID before commit
         return new_patient
 
-    def _ingest_allergies(self, soup, section, patient):
-        count = 0
+    def _ingest_allergies(self, soup, section):
         # Include nested entries to match PythonVersion behavior
         for entry in section.select('entry'):
             if entry.select_one('observation[negationInd="true"]'):
@@ -168,46 +302,36 @@ class DataImporter:
                 'participant[typeCode="CSM"] > participantRole > playingEntity > code',
             )
             effective_date = self._find_attrib(entry, 'effectiveTime low', 'value')
-
-            if not self.session.query(Allergy).filter_by(
-                patient_id=patient.id, substance=substance, effective_date=effective_date
-            ).first():
-                new_allergy = Allergy(
-                    patient_id=patient.id,
+            self._add_record(
+                Allergy,
+                dict(substance=substance, effective_date=effective_date),
+                dict(
                     substance=substance,
                     reaction=self._find_attrib(entry, 'observation value', 'displayName'),
                     status=self._find_attrib(entry, 'act > statusCode', 'code') or self._find_attrib(entry, 'statusCode', 'code'),
                     effective_date=effective_date,
-                )
-                self.session.add(new_allergy)
-                count += 1
-        return count
+                ),
+            )
 
-    def _ingest_problems(self, soup, section, patient):
-        count = 0
+    def _ingest_problems(self, soup, section):
         for entry in section.select('entry'):
             obs = entry.select_one('observation')
             if not obs:
                 continue
             problem_name = self._find_name_with_fallback(soup, obs, 'value')
             onset_date = self._find_attrib(obs, 'effectiveTime low', 'value')
-
-            if not self.session.query(Problem).filter_by(
-                patient_id=patient.id, problem_name=problem_name, onset_date=onset_date
-            ).first():
-                new_problem = Problem(
-                    patient_id=patient.id,
+            self._add_record(
+                Problem,
+                dict(problem_name=problem_name, onset_date=onset_date),
+                dict(
                     problem_name=problem_name,
                     onset_date=onset_date,
                     status=self._find_attrib(obs, 'entryRelationship observation value', 'displayName'),
                     resolved_date=self._find_attrib(obs, 'effectiveTime high', 'value'),
-                )
-                self.session.add(new_problem)
-                count += 1
-        return count
+                ),
+            )
 
-    def _ingest_medications(self, soup, section, patient):
-        count = 0
+    def _ingest_medications(self, soup, section):
         for entry in section.select('entry > substanceAdministration'):
             med_name = self._find_name_with_fallback(
                 soup, entry, 'consumable > manufacturedProduct > manufacturedMaterial > code'
@@ -230,23 +354,19 @@ class DataImporter:
                             if ref_target is not None:
                                 instructions = ref_target.get_text(strip=True)
 
-            if not self.session.query(Medication).filter_by(
-                patient_id=patient.id, medication_name=med_name, start_date=start_date
-            ).first():
-                new_med = Medication(
-                    patient_id=patient.id,
+            self._add_record(
+                Medication,
+                dict(medication_name=med_name, start_date=start_date),
+                dict(
                     medication_name=med_name,
                     start_date=start_date,
                     instructions=instructions,
                     status=self._find_attrib(entry, 'statusCode', 'code'),
                     end_date=self._find_attrib(entry, 'effectiveTime high', 'value'),
-                )
-                self.session.add(new_med)
-                count += 1
-        return count
+                ),
+            )
 
-    def _ingest_immunizations(self, soup, section, patient):
-        count = 0
+    def _ingest_immunizations(self, soup, section):
         for entry in section.select('entry > substanceAdministration'):
             vaccine_name = self._find_name_with_fallback(
                 soup, entry, 'consumable > manufacturedProduct > manufacturedMaterial > code'
@@ -256,41 +376,27 @@ class DataImporter:
                 self._find_attrib(entry, 'effectiveTime', 'value')
                 or self._find_attrib(entry, 'effectiveTime > low', 'value')
             )
+            fields = dict(vaccine_name=vaccine_name, date_administered=date_administered)
+            self._add_record(Immunization, fields, dict(fields))
 
-            if not self.session.query(Immunization).filter_by(
-                patient_id=patient.id,
-                vaccine_name=vaccine_name,
-                date_administered=date_administered,
-            ).first():
-                new_imm = Immunization(
-                    patient_id=patient.id,
-                    vaccine_name=vaccine_name,
-                    date_administered=date_administered,
-                )
-                self.session.add(new_imm)
-                count += 1
-        return count
-
-    def _ingest_vitals(self, soup, section, patient):
-        count = 0
+    def _ingest_vitals(self, soup, section):
         for comp in section.select('component > observation'):
             vital_sign = self._find_name_with_fallback(soup, comp, 'code')
             if not vital_sign: continue
             
             effective_date = self._find_attrib(comp, 'effectiveTime', 'value')
-            if not self.session.query(Vital).filter_by(patient_id=patient.id, vital_sign=vital_sign, effective_date=effective_date).first():
-                value_el = comp.find('value')
-                new_vital = Vital(
-                    patient_id=patient.id, vital_sign=vital_sign, effective_date=effective_date,
+            value_el = comp.find('value')
+            self._add_record(
+                Vital,
+                dict(vital_sign=vital_sign, effective_date=effective_date),
+                dict(
+                    vital_sign=vital_sign, effective_date=effective_date,
                     value=value_el.get('value') if value_el else None,
                     unit=value_el.get('unit') if value_el else None
-                )
-                self.session.add(new_vital)
-                count += 1
-        return count
+                ),
+            )
 
-    def _ingest_results(self, soup, section, patient):
-        count = 0
+    def _ingest_results(self, soup, section):
         # Follow PythonVersion: iterate organizers, keep panel name
         for organizer in section.select('organizer'):
             panel_name = (
@@ -302,68 +408,63 @@ class DataImporter:
                 if not test_name:
                     continue
                 effective_date = self._find_attrib(comp, 'effectiveTime', 'value')
-                if not self.session.query(Result).filter_by(
-                    patient_id=patient.id, test_name=test_name, effective_date=effective_date
-                ).first():
-                    value_el = comp.find('value')
-                    value, unit = (None, None)
-                    if value_el:
-                        value = value_el.get('value') or value_el.get('displayName') or value_el.text
-                        unit = value_el.get('unit')
-                    new_result = Result(
-                        patient_id=patient.id,
-                        test_name=f"{panel_name}: {test_name}" if panel_name else test_name,
+                value_el = comp.find('value')
+                value, unit = (None, None)
+                if value_el:
+                    value = value_el.get('value') or value_el.get('displayName') or value_el.text
+                    unit = value_el.get('unit')
+                # Match duplicates on the stored (panel-prefixed) name: the unique constraint is on
+                # that value, so matching the raw test name missed panel results on re-import
+                stored_name = f"{panel_name}: {test_name}" if panel_name else test_name
+                self._add_record(
+                    Result,
+                    dict(test_name=stored_name, effective_date=effective_date),
+                    dict(
+                        test_name=stored_name,
                         effective_date=effective_date,
                         value=value,
                         unit=unit,
                         reference_range=self._find_text(comp, 'referenceRange observationRange text'),
                         interpretation=self._find_attrib(comp, 'interpretationCode', 'displayName'),
-                    )
-                    self.session.add(new_result)
-                    count += 1
+                    ),
+                )
         # As in PythonVersion, also ingest any notes embedded in this section
-        count += self._ingest_notes(soup, section, patient)
-        return count
+        self._ingest_notes(soup, section)
 
-    def _ingest_procedures(self, soup, section, patient):
-        count = 0
+    def _ingest_procedures(self, soup, section):
         for proc in section.select('entry > procedure'):
             proc_name = self._find_name_with_fallback(soup, proc, 'code') or self._find_name_with_fallback(soup, proc, 'participant[typeCode="DEV"] > participantRole > playingDevice > code')
             date = self._find_attrib(proc, 'effectiveTime low', 'value') or self._find_attrib(proc, 'effectiveTime', 'value')
-
-            if not self.session.query(Procedure).filter_by(patient_id=patient.id, procedure_name=proc_name, date=date).first():
-                new_proc = Procedure(
-                    patient_id=patient.id, procedure_name=proc_name, date=date,
+            self._add_record(
+                Procedure,
+                dict(procedure_name=proc_name, date=date),
+                dict(
+                    procedure_name=proc_name, date=date,
                     provider=self._find_text(proc, 'performer assignedEntity assignedPerson name')
-                )
-                self.session.add(new_proc)
-                count += 1
-        return count
+                ),
+            )
         
-    def _ingest_notes(self, soup, section, patient):
-        count = 0
+    def _ingest_notes(self, soup, section):
         text_el = section.find('text')
-        if not text_el: return 0
+        if not text_el: return
             
         note_content = "\n".join(line.strip() for line in text_el.stripped_strings)
-        if not note_content: return 0
+        if not note_content: return
 
         note_title = self._find_text(section, 'title') or "Clinical Note"
         note_date_el = soup.select_one('encompassingEncounter > effectiveTime > low') or soup.find('effectiveTime')
         note_date = note_date_el.get('value') if note_date_el else None
 
-        if not self.session.query(Note).filter_by(patient_id=patient.id, note_date=note_date, note_title=note_title).first():
-            provider_el = soup.select_one('encompassingEncounter performer assignedPerson name')
-            provider = provider_el.get_text(strip=True) if provider_el else None
-            
-            new_note = Note(
-                patient_id=patient.id,
+        provider_el = soup.select_one('encompassingEncounter performer assignedPerson name')
+        provider = provider_el.get_text(strip=True) if provider_el else None
+        self._add_record(
+            Note,
+            dict(note_date=note_date, note_title=note_title),
+            dict(
                 note_type=self._find_attrib(section, 'code', 'displayName') or 'Note',
                 note_date=note_date,
                 note_title=note_title,
                 note_content=note_content,
                 provider=provider
-            )
-            self.session.add(new_note)
-            count += 1
-        return count
+            ),
+        )
@@ -7,8 +7,10 @@ import streamlit as st
 import requests
 import json
 import re
+import math
 from sqlalchemy import text, inspect
-from typing import Callable
+from typing import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .config import (
     get_preview_limits_global,
     get_notes_snippet_max_chars,
@@ -17,6 +19,55 @@ from .config import (
 from .admin import get_user_provisioned_openrouter_key
 from datetime import date, datetime
 
+
+# SQL normalization patterns, compiled once at import
+_UNSAFE_SQL_RE = re.compile(r"\b(insert|update|delete|create|alter|drop|attach|detach|vacuum|pragma)\b")
+_BIND_PARAM_RE = re.compile(r":[A-Za-z_][A-Za-z0-9_]*")
+_PATIENT_ID_EQ_RE = re.compile(r"((?:[A-Za-z_][A-Za-z0-9_]*\.)?)patient_id\s*=\s*(\?|:[A-Za-z_][A-Za-z0-9_]*|\d+)")
+_WORD_RE = re.compile(r"[a-z0-9]{3,}")
+
+
+def _term_vector(content: str) -> dict[str, float]:
+    """Unit-length bag-of-words vector for one message.
+
+    Deliberately not memoized: a process-wide cache would keep decrypted chat text
+    from every user alive after their sessions end. Histories are short, so this is cheap.
+    """
+    counts: dict[str, float] = {}
+    for w in _WORD_RE.findall(content.lower()):
+        counts[w] = counts.get(w, 0.0) + 1.0
+    norm = math.sqrt(sum(v * v for v in counts.values())) or 1.0
+    return {w: v / norm for w, v in counts.items()}
+
+
+def _cosine(a: dict[str, float], b: dict[str, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(v * b.get(w, 0.0) for w, v in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def _current_script_ctx():
+    """Return the active Streamlit ScriptRunContext (None outside a script run)."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        return get_script_run_ctx()
+    except Exception:
+        return None
+
+
+def _attach_script_ctx(ctx) -> None:
+    """Thread-pool initializer: let worker threads read st.session_state/st.secrets."""
+    if ctx is None:
+        return
+    try:
+        import threading
+        from streamlit.runtime.scriptrunner import add_script_run_ctx
+        add_script_run_ctx(threading.current_thread(), ctx)
+    except Exception:
+        pass
+
 class LLMService:
     """
     A class to interact with different LLM backends.
@@ -316,8 +367,7 @@ class LLMService:
             if not (lowered.startswith("select") or lowered.startswith("with")):
                 return ""
             # Disallow dangerous keywords anywhere using word boundaries to avoid false positives
-            import re as _re
-            if _re.search(r"\b(insert|update|delete|create|alter|drop|attach|detach|vacuum|pragma)\b", lowered):
+            if _UNSAFE_SQL_RE.search(lowered):
                 return ""
             # If starts with WITH, ensure it eventually leads to a SELECT and not DML
             if lowered.startswith("with") and "select" not in lowered:
@@ -471,9 +521,10 @@ Guidelines:
             items = [line for line in raw.splitlines() if line.strip()]
         cleaned: list[str] = []
         seen = set()
+        pids = self._get_current_patient_ids()
         for s in items:
             q = self._sanitize_sql(s)
-            q = self._inline_patient_id(q)
+            q = self._inline_patient_id(q, pids)
             if not q:
                 continue
             if q in seen:
@@ -572,9 +623,13 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
 
     def retrieve_batch(self, question: str, max_queries: int = 4, max_retries: int = 1,
                        progress_cb: Callable[[str], None] | None = None,
-                       chat_history: list[dict] | None = None):
+                       chat_history: list[dict] | None = None,
+                       concurrency: int = 4):
         """Best-effort retrieval of multiple small queries.
 
+        Queries (and their optional LLM correction) run concurrently on up to
+        `concurrency` worker threads; results keep the original query order.
+
         Returns a list of dicts: [{"sql": str, "rows": list, "error": Optional[str]}]
         """
         if progress_cb:
@@ -638,54 +693,75 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
         run_queries = extra_queries + queries
         # Avoid producing too many tabs; cap execution to extras + max_queries
         max_to_run = min(len(run_queries), len(extra_queries) + max_queries)
+        run_queries = run_queries[:max_to_run]
 
-        results = []
+        def _emit(msg: str) -> None:
+            if progress_cb:
+                try:
+                    progress_cb(msg)
+                except Exception:
+                    pass
+
+        # Announce all queries up front; workers buffer their own progress lines and
+        # the calling thread emits them as each query completes, so progress_cb (which
+        # touches Streamlit elements) is never invoked from a worker thread.
         for idx, q in enumerate(run_queries):
-            if idx >= max_to_run:
-                break
-            try:
-                # Compute a short table label for this query (best-effort)
-                tbl = self._first_table_label(q)
-                short_desc = self._short_sql_desc(q)
-                if progress_cb:
-                    try:
-                        label = f"Executing query {idx + 1}/{max_to_run}"
-                        if short_desc:
-                            label += f" — {short_desc}"
-                        elif tbl:
-                            label += f" ({tbl})"
-                        label += "…"
-                        progress_cb(label)
-                    except Exception:
-                        pass
-                rows = self.execute_sql(q)
-                results.append({"sql": q, "rows": rows, "error": None})
-                if progress_cb:
-                    try:
-                        label = f"✓ Query {idx + 1}"
-                        if short_desc:
-                            label += f" — {short_desc}"
-                        elif tbl:
-                            label += f" ({tbl})"
-                        label += f": {len(rows)} row(s)"
-                        progress_cb(label)
-                    except Exception:
-                        pass
-            except Exception as e:
-                if max_retries > 0:
-                    # try one correction for this query
-                    if progress_cb:
-                        try:
-                            label = f"Retrying query {idx + 1}"
-                            if short_desc:
-                                label += f" — {short_desc}"
-                            elif tbl:
-                                label += f" ({tbl})"
-                            label += f" after error: {str(e)[:120]}"
-                            progress_cb(label)
-                        except Exception:
-                            pass
-                    retry_prompt = f"""
+            label = f"Executing query {idx + 1}/{max_to_run}"
+            short_desc = self._short_sql_desc(q)
+            tbl = self._first_table_label(q)
+            if short_desc:
+                label += f" — {short_desc}"
+            elif tbl:
+                label += f" ({tbl})"
+            _emit(label + "…")
+
+        if not run_queries:
+            return []
+        cfg = self._load_config()
+        results: list[dict | None] = [None] * len(run_queries)
+        workers = max(1, min(int(concurrency or 1), len(run_queries)))
+        with ThreadPoolExecutor(max_workers=workers, initializer=_attach_script_ctx, initargs=(_current_script_ctx(),)) as ex:
+            futures = {
+                ex.submit(self._run_batch_query, question, idx, q, max_retries, cfg): idx
+                for idx, q in enumerate(run_queries)
+            }
+            for fut in as_completed(futures):
+                idx = futures[fut]
+                result, messages = fut.result()
+                results[idx] = result
+                for msg in messages:
+                    _emit(msg)
+        return [r for r in results if r is not None]
+
+    def _run_batch_query(self, question: str, idx: int, q: str, max_retries: int, cfg: dict):
+        """Execute one batch query (with a single LLM-assisted correction on error).
+
+        Thread-safe helper for retrieve_batch. Returns (result_dict, progress_messages);
+        progress messages are returned rather than emitted so the caller can report
+        them from the Streamlit script thread.
+        """
+        messages: list[str] = []
+        # Compute a short table label for this query (best-effort)
+        tbl = self._first_table_label(q)
+        short_desc = self._short_sql_desc(q)
+
+        def _label(prefix: str, desc: str | None, table: str | None, suffix: str) -> str:
+            label = prefix
+            if desc:
+                label += f" — {desc}"
+            elif table:
+                label += f" ({table})"
+            return label + suffix
+
+        try:
+            rows = self.execute_sql(q)
+            messages.append(_label(f"✓ Query {idx + 1}", short_desc, tbl, f": {len(rows)} row(s)"))
+            return {"sql": q, "rows": rows, "error": None}, messages
+        except Exception as e:
+            if max_retries > 0:
+                # try one correction for this query
+                messages.append(_label(f"Retrying query {idx + 1}", short_desc, tbl, f" after error: {str(e)[:120]}"))
+                retry_prompt = f"""
 Your previous SQL had an error when executed on SQLite.
 Question: {question}
 Error: {str(e)}
@@ -696,8 +772,8 @@ Using the schema below, produce a corrected single SELECT/WITH statement for SQL
 It must be valid SQL, no markdown, no comments, no code fences. Do NOT use parameters (? or :name); inline literal values only.
 {('Use patient_id IN (' + ', '.join(str(i) for i in self._get_current_patient_ids()) + ') where relevant.') if self._get_current_patient_ids() else ''}
 {self._get_db_schema()}
-                    """
-                    cfg = self._load_config()
+                """
+                try:
                     raw_sql2 = (
                         self._query_ollama(retry_prompt, cfg)
                         if cfg["llm_provider"] == "ollama"
@@ -711,55 +787,24 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
                             ),
                         )
                     )
-                    sql2 = self._sanitize_sql(raw_sql2)
-                    sql2 = self._inline_patient_id(sql2)
-                    if sql2:
-                        try:
-                            rows2 = self.execute_sql(sql2)
-                            results.append({"sql": sql2, "rows": rows2, "error": None})
-                            # Update table label/desc from corrected SQL if available
-                            tbl2 = self._first_table_label(sql2) or tbl
-                            short_desc2 = self._short_sql_desc(sql2) or short_desc
-                            if progress_cb:
-                                try:
-                                    label = f"✓ Query {idx + 1}"
-                                    if short_desc2:
-                                        label += f" — {short_desc2}"
-                                    elif tbl2:
-                                        label += f" ({tbl2})"
-                                    label += f" retry: {len(rows2)} row(s)"
-                                    progress_cb(label)
-                                except Exception:
-                                    pass
-                            continue
-                        except Exception as e2:
-                            results.append({"sql": sql2, "rows": [], "error": str(e2)})
-                            if progress_cb:
-                                try:
-                                    label = f"✗ Query {idx + 1}"
-                                    if short_desc:
-                                        label += f" — {short_desc}"
-                                    elif tbl:
-                                        label += f" ({tbl})"
-                                    label += f" retry failed: {str(e2)[:120]}"
-                                    progress_cb(label)
-                                except Exception:
-                                    pass
-                            continue
-                # if no retry or still failing
-                results.append({"sql": q, "rows": [], "error": str(e)})
-                if progress_cb:
+                except Exception:
+                    raw_sql2 = ""
+                sql2 = self._sanitize_sql(raw_sql2)
+                sql2 = self._inline_patient_id(sql2)
+                if sql2:
                     try:
-                        label = f"✗ Query {idx + 1}"
-                        if short_desc:
-                            label += f" — {short_desc}"
-                        elif tbl:
-                            label += f" ({tbl})"
-                        label += f" failed: {str(e)[:120]}"
-                        progress_cb(label)
-                    except Exception:
-                        pass
-        return results
+                        rows2 = self.execute_sql(sql2)
+                        # Update table label/desc from corrected SQL if available
+                        tbl2 = self._first_table_label(sql2) or tbl
+                        short_desc2 = self._short_sql_desc(sql2) or short_desc
+                        messages.append(_label(f"✓ Query {idx + 1}", short_desc2, tbl2, f" retry: {len(rows2)} row(s)"))
+                        return {"sql": sql2, "rows": rows2, "error": None}, messages
+                    except Exception as e2:
+                        messages.append(_label(f"✗ Query {idx + 1}", short_desc, tbl, f" retry failed: {str(e2)[:120]}"))
+                        return {"sql": sql2, "rows": [], "error": str(e2)}, messages
+            # if no retry or still failing
+            messages.append(_label(f"✗ Query {idx + 1}", short_desc, tbl, f" failed: {str(e)[:120]}"))
+            return {"sql": q, "rows": [], "error": str(e)}, messages
 
     def consult(self, question: str, rows) -> str:
         # Compact preview of retrieved rows (single set). Allow answering even if no rows, by combining general knowledge.
@@ -814,18 +859,17 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
         else:
             raise ValueError("Unsupported LLM provider")
 
-    def consult_conversation(self, chat_history: list[dict], rows_history: list[list]) -> str:
-        """Consult using the full conversation so far and all retrieved data so far.
+    def _build_conversation_consult_prompt(self, chat_history: list[dict], rows_history: list[list]) -> str:
+        """Build the consult prompt from the conversation so far and all retrieved data so far.
 
         - Includes patient context
-        - Summarizes conversation (last ~12 messages) with role labels
+        - Includes the last two exchanges plus the three most relevant earlier ones
         - Includes previews from all result sets gathered so far (up to 8 sets, 10 rows each)
         - Asks the model to answer the last user question
         """
-        # Build conversation transcript
+        # Build conversation transcript from the recent and most relevant exchanges
         hist = chat_history or []
-        # keep the last 12 messages for brevity
-        hist_tail = hist[-12:]
+        hist_tail = self._select_consult_memory(hist)
         lines = []
         for m in hist_tail:
             role = m.get("role", "user")
@@ -846,15 +890,56 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
         results_str = "\n\n".join(previews) if previews else "(no rows collected)"
 
         # Last user question (fallback to empty)
-        last_q = next((m.get("content") for m in reversed(hist_tail) if m.get("role") == "user"), "")
+        last_q = next((m.get("content") for m in reversed(hist) if m.get("role") == "user"), "")
 
         patient_context = self._get_patient_context_text()
-        final_prompt = self._build_consult_prompt(
+        return self._build_consult_prompt(
             question=last_q or "",
             patient_context=patient_context,
             data_str=results_str,
             convo_summary=convo_str,
         )
+
+    def _select_consult_memory(self, chat_history: list[dict], top_k: int = 3, recent_turns: int = 2) -> list[dict]:
+        """Pick the messages the consult prompt should see, so its size stays bounded.
+
+        - Groups messages into exchanges (a user message plus the replies after it)
+        - Always keeps the last `recent_turns` exchanges verbatim
+        - Adds up to `top_k` older exchanges most similar to the current question
+          (bag-of-words cosine; no embedding backend needed)
+        - Returns the chosen messages in their original order
+        """
+        exchanges: list[list[dict]] = []
+        for m in chat_history or []:
+            if m.get("role") == "user" or not exchanges:
+                exchanges.append([m])
+            else:
+                exchanges[-1].append(m)
+        if len(exchanges) <= recent_turns + top_k:
+            return [m for ex in exchanges for m in ex]
+
+        older = exchanges[:-recent_turns] if recent_turns else exchanges
+        recent = exchanges[-recent_turns:] if recent_turns else []
+        question = next(
+            (str(m.get("content", "")) for m in reversed(chat_history) if m.get("role") == "user"), ""
+        )
+        q_vec = _term_vector(question)
+        scored = []
+        for i, ex in enumerate(older):
+            ex_vec: dict[str, float] = {}
+            for m in ex:
+                for w, v in _term_vector(str(m.get("content", ""))).items():
+                    ex_vec[w] = ex_vec.get(w, 0.0) + v
+            score = _cosine(q_vec, ex_vec)
+            if score > 0:
+                scored.append((score, i))
+        keep = sorted(i for _, i in sorted(scored, reverse=True)[:top_k])
+        picked = [older[i] for i in keep] + recent
+        return [m for ex in picked for m in ex]
+
+    def consult_conversation(self, chat_history: list[dict], rows_history: list[list]) -> str:
+        """Consult using the full conversation so far and all retrieved data so far."""
+        final_prompt = self._build_conversation_consult_prompt(chat_history, rows_history)
         cfg = self._load_config()
         if cfg["llm_provider"] == "ollama":
             return self._query_ollama(final_prompt, cfg)
@@ -869,6 +954,38 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
         else:
             raise ValueError("Unsupported LLM provider")
 
+    def consult_conversation_stream(self, chat_history: list[dict], rows_history: list[list]) -> Iterator[str]:
+        """Streaming variant of consult_conversation; yields text chunks as they arrive.
+
+        Suitable for st.write_stream. If the streaming request fails before any text
+        is produced, falls back to the blocking call and yields the full answer once.
+        """
+        final_prompt = self._build_conversation_consult_prompt(chat_history, rows_history)
+        cfg = self._load_config()
+        if cfg["llm_provider"] == "ollama":
+            stream = self._query_ollama_stream(final_prompt, cfg)
+            fallback = lambda: self._query_ollama(final_prompt, cfg)
+        elif cfg["llm_provider"] == "openrouter":
+            kwargs = dict(
+                system_instruction=self._consult_system_instruction(),
+                max_tokens=900,
+                temperature=0.2,
+            )
+            stream = self._query_openrouter_stream(final_prompt, cfg, **kwargs)
+            fallback = lambda: self._query_openrouter(final_prompt, cfg, **kwargs)
+        else:
+            raise ValueError("Unsupported LLM provider")
+        produced = False
+        try:
+            for chunk in stream:
+                if chunk:
+                    produced = True
+                    yield chunk
+        except Exception:
+            if produced:
+                raise
+            yield fallback()
+
     def _insufficient_message(self) -> str:
         """Standard response when no relevant chart data is available to answer."""
         return (
@@ -905,15 +1022,24 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
 
         max_rows, char_budget, _ = self._get_preview_limits()
 
-        # Work on a shallow copy to avoid mutating caller's list
-        rows_local = list(rows)
+        # Work on a shallow copy to avoid mutating caller's list.
+        # Arrow tables (session row cache) are expanded to dict rows here.
+        rows_local = rows.to_pylist() if hasattr(rows, "to_pylist") else list(rows)
+        if not rows_local:
+            return []
+
+        def _as_mapping(r):
+            m = getattr(r, "_mapping", None)
+            if m is not None:
+                return m
+            return r if isinstance(r, dict) else None
 
         # Detect mapping rows and columns
-        mapping_mode = hasattr(rows_local[0], "_mapping")
+        mapping_mode = _as_mapping(rows_local[0]) is not None
         cols = []
         if mapping_mode:
             try:
-                cols = list(rows_local[0]._mapping.keys())
+                cols = list(_as_mapping(rows_local[0]).keys())
             except Exception:
                 cols = []
 
@@ -925,7 +1051,7 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
 
         def _row_get(r, k):
             try:
-                return r._mapping.get(k)
+                return _as_mapping(r).get(k)
             except Exception:
                 return None
 
@@ -966,7 +1092,7 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
                 break
             try:
                 if mapping_mode:
-                    m = r._mapping
+                    m = _as_mapping(r)
                     parts = []
                     for c in preferred_cols:
                         v = m.get(c)
@@ -1064,6 +1190,45 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
             out = out[: target_chars - 3] + "..."
         return out
 
+    def _ollama_base_url(self, cfg: dict) -> str:
+        """Resolve the Ollama base URL, restricted to http(s) on loopback."""
+        # Determine base URL: use configured value or fall back to local default
+        raw_url = (cfg.get("ollama_url") or "http://localhost:11434").strip()
+        # Allow only http/https schemes and strip trailing slash
+        try:
+            from urllib.parse import urlparse
+            parsed = urlparse(raw_url)
+            host = (parsed.hostname or "").lower()
+            if parsed.scheme not in ("http", "https"):
+                return "http://localhost:11434"
+            if host not in ("localhost", "127.0.0.1"):
+                # Restrict to loopback to avoid SSRF; remote access should use SSH tunnel which also binds localhost
+                return "http://localhost:11434"
+            return raw_url.rstrip("/")
+        except Exception:
+            return "http://localhost:11434"
+
+    def _query_ollama_stream(self, prompt, cfg=None) -> Iterator[str]:
+        """Stream a completion from the Ollama API (newline-delimited JSON chunks)."""
+        cfg = cfg or self._load_config()
+        payload = {
+            "model": cfg["ollama_model"],
+            "prompt": prompt,
+            "stream": True,
+        }
+        base_url = self._ollama_base_url(cfg)
+        with requests.post(f"{base_url}/api/generate", json=payload, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                chunk = data.get("response")
+                if chunk:
+                    yield chunk
+                if data.get("done"):
+                    break
+
     def _query_ollama(self, prompt, cfg=None):
         """
         Queries the Ollama API.
@@ -1075,22 +1240,7 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
             "prompt": prompt,
             "stream": False
         }
-        # Determine base URL: use configured value or fall back to local default
-        raw_url = (cfg.get("ollama_url") or "http://localhost:11434").strip()
-        # Allow only http/https schemes and strip trailing slash
-        try:
-            from urllib.parse import urlparse
-            parsed = urlparse(raw_url)
-            host = (parsed.hostname or "").lower()
-            if parsed.scheme not in ("http", "https"):
-                base_url = "http://localhost:11434"
-            elif host not in ("localhost", "127.0.0.1"):
-                # Restrict to loopback to avoid SSRF; remote access should use SSH tunnel which also binds localhost
-                base_url = "http://localhost:11434"
-            else:
-                base_url = raw_url.rstrip("/")
-        except Exception:
-            base_url = "http://localhost:11434"
+        base_url = self._ollama_base_url(cfg)
         # Make a POST request to the Ollama API
         response = requests.post(f"{base_url}/api/generate", json=payload)
         # Raise an exception if the request was unsuccessful
@@ -1114,6 +1264,57 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
         - Optional system instruction
         - Basic error handling with graceful fallbacks
         """
+        url, headers, body = self._openrouter_request(
+            prompt, cfg, system_instruction, max_tokens, temperature, force_json
+        )
+        resp = requests.post(url, headers=headers, data=json.dumps(body), timeout=60)
+        resp.raise_for_status()
+        data = resp.json()
+        try:
+            text = data["choices"][0]["message"]["content"]
+        except Exception:
+            text = ""
+        return (text or "").strip()
+
+    def _query_openrouter_stream(
+        self,
+        prompt: str,
+        cfg=None,
+        system_instruction: str | None = None,
+        max_tokens: int | None = None,
+        temperature: float | None = None,
+    ) -> Iterator[str]:
+        """Stream a chat completion from OpenRouter (server-sent events)."""
+        url, headers, body = self._openrouter_request(
+            prompt, cfg, system_instruction, max_tokens, temperature, False
+        )
+        body["stream"] = True
+        with requests.post(url, headers=headers, data=json.dumps(body), timeout=60, stream=True) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines(decode_unicode=True):
+                # SSE payload lines look like "data: {...}"; others are keep-alive comments
+                if not line or not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(payload)["choices"][0].get("delta", {}).get("content")
+                except Exception:
+                    chunk = None
+                if chunk:
+                    yield chunk
+
+    def _openrouter_request(
+        self,
+        prompt: str,
+        cfg=None,
+        system_instruction: str | None = None,
+        max_tokens: int | None = None,
+        temperature: float | None = None,
+        force_json: bool = False,
+    ) -> tuple[str, dict, dict]:
+        """Return (url, headers, body) for an OpenRouter chat/completions call."""
         cfg = cfg or self._load_config()
         api_key = (cfg.get("openrouter_api_key") or "").strip()
         # If user did not set a key, try admin-provisioned key for this user
@@ -1154,15 +1355,7 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
             body["max_tokens"] = int(max_tokens)
         if force_json:
             body["response_format"] = {"type": "json_object"}
-
-        resp = requests.post(url, headers=headers, data=json.dumps(body), timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
-        try:
-            text = data["choices"][0]["message"]["content"]
-        except Exception:
-            text = ""
-        return (text or "").strip()
+        return url, headers, body
 
     def ask_question(self, question):
         """Backward-compatible single-step ask that uses the new pipeline."""
@@ -1292,20 +1485,22 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
         except Exception:
             return []
 
-    def _inline_patient_id(self, sql: str) -> str:
+    def _inline_patient_id(self, sql: str, pids: list[int] | None = None) -> str:
         """Replace patient_id parameter placeholders with the current patient id(s) literal.
 
         - Only operates outside quotes
     - Replaces patterns like: patient_id = ?  or patient_id = :patient_id or patient_id = 123 with IN (...)
         - Leaves SQL unchanged if no patient ids available
         - After replacement, if any remaining parameter markers (? or :name) exist, returns empty string to trigger retry
+        - `pids` may be passed in to avoid re-querying the patients table per statement
         """
         if not sql:
             return sql
-        pids = self._get_current_patient_ids()
+        if pids is None:
+            pids = self._get_current_patient_ids()
         if not pids:
             # If SQL contains parameter placeholders, reject to force retry without params
-            if "?" in sql or re.search(r":[A-Za-z_][A-Za-z0-9_]*", sql):
+            if "?" in sql or _BIND_PARAM_RE.search(sql):
                 return ""
             return sql
 
@@ -1330,23 +1525,38 @@ It must be valid SQL, no markdown, no comments, no code fences. Do NOT use param
                 continue
             if not in_squote and not in_dquote:
                 # Try regex from this position for alias?.patient_id = (?|:name|123)
-                m = re.match(r"((?:[A-Za-z_][A-Za-z0-9_]*\.)?)patient_id\s*=\s*(\?|:[A-Za-z_][A-Za-z0-9_]*|\d+)", sql[i:])
+                m = _PATIENT_ID_EQ_RE.match(sql, i)
                 if m:
                     # Preserve optional alias prefix
                     prefix = m.group(1) or ""
                     repl = f"{prefix}patient_id IN ({in_list})"
                     out.append(repl)
-                    i += m.end()
+                    i = m.end()
                     continue
             out.append(ch)
             i += 1
 
         s2 = "".join(out)
         # If any other bind params remain, reject and force retry
-        if "?" in s2 or re.search(r":[A-Za-z_][A-Za-z0-9_]*", s2):
+        if "?" in s2 or _BIND_PARAM_RE.search(s2):
             return ""
         return s2
 
+    def sanitize_and_inline_many(self, sqls: list[str]) -> list[str]:
+        """Sanitize and inline patient ids for many statements (e.g. a saved sql_history).
+
+        The patients table is queried once for the whole list. Output is aligned with
+        the input; statements that fail validation become empty strings.
+        """
+        pids = self._get_current_patient_ids()
+        cleaned: list[str] = []
+        for s in (sqls or []):
+            try:
+                cleaned.append(self._inline_patient_id(self._sanitize_sql(s), pids))
+            except Exception:
+                cleaned.append("")
+        return cleaned
+
     def _table_has_column(self, table: str, column: str) -> bool:
         try:
             insp = inspect(self.db_engine)
@@ -5,15 +5,523 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import re
-import time
+import uuid
+import threading
+from html import escape as _esc_html
+from concurrent.futures import ThreadPoolExecutor
 st.set_page_config(page_title="MyChart Explorer", layout="wide")
-from modules.database import get_session, get_db_engine
+from modules.database import get_session
+from modules.engine_cache import get_cached_engine, key_fingerprint
 from modules.llm_service import LLMService
-from modules.conversations import list_conversations, save_conversation, load_conversation, delete_conversation
+from modules.conversations import (
+    list_conversations, save_conversation, load_conversation, delete_conversation, new_conversation_id,
+)
 from modules.config import load_configuration, save_configuration
 from modules.auth import check_auth
 from modules.ui import render_footer
 
+
+# Disclaimer shown above every assistant reply (built once at import)
+_DISCLAIMER_HTML = (
+    "<div style=\"font-size:0.85rem; line-height:1.25rem; color:#7c2d12; "
+    "background:#fff7ed; border:1px solid #fdba74; padding:8px 10px; "
+    "border-radius:8px; margin:0 0 6px 0;\">"
+    "<strong>Not medical advice:</strong> The assistant's response is for informational purposes only. "
+    "Always consult a qualified clinician for medical advice."
+    "</div>"
+)
+
+# Number of settled chat messages rendered per run before older ones are collapsed
+_HISTORY_WINDOW = 30
+
+
+@st.cache_data(ttl=300, max_entries=64, show_spinner=False)
+def _cached_list_conversations(username: str, key_fp: str, _key: str):
+    """Cached conversation listing keyed on (username, key fingerprint).
+
+    The raw key is passed as `_key` so Streamlit excludes it from the cache hash.
+    Call `_cached_list_conversations.clear()` after saving or deleting.
+    """
+    return list_conversations(username, _key)
+
+
+# Autosave once at least this many messages (one question + reply) are new
+_AUTOSAVE_MIN_NEW_MESSAGES = 2
+# Serializes background writes so two autosaves never interleave on one file
+_AUTOSAVE_LOCK = threading.Lock()
+
+
+def _maybe_autosave() -> None:
+    """Save the open conversation in a background thread once enough is new.
+
+    Every autosave of a conversation overwrites the same file
+    (`autosave_conv_id`), so saves don't pile up as separate copies.
+    """
+    if not st.session_state.get('autosave_conversations', False):
+        return
+    # Shared with the save thread, which can't write st.session_state itself
+    status = st.session_state.setdefault('_autosave_status', {})
+    if status.get('error'):
+        # The last save failed: retry with this reply
+        st.session_state['autosaved_len'] = 0
+    username = st.session_state.get("username")
+    key = st.session_state.get("db_encryption_key")
+    history = st.session_state.get('chat_history') or []
+    if not (username and key and history):
+        return
+    if len(history) - st.session_state.get('autosaved_len', 0) < _AUTOSAVE_MIN_NEW_MESSAGES:
+        return
+    conv_id = st.session_state.get('autosave_conv_id') or new_conversation_id(history)
+    st.session_state['autosave_conv_id'] = conv_id
+    st.session_state['autosaved_len'] = len(history)
+    # Snapshot now: the thread must not see later appends or touch st.session_state
+    args = (list(history), username, key)
+    kwargs = {
+        "title": st.session_state.get('autosave_title'),
+        "conv_id": conv_id,
+        "sql_history": list(st.session_state.get('sql_history') or []),
+        "batches": list(st.session_state.get('batch_history') or []),
+    }
+
+    def _bg_save():
+        try:
+            with _AUTOSAVE_LOCK:
+                save_conversation(*args, **kwargs)
+            status.pop('error', None)
+            _cached_list_conversations.clear()
+        except Exception as e:
+            status['error'] = str(e) or type(e).__name__
+
+    threading.Thread(target=_bg_save, daemon=True).start()
+
+
+def _render_progress_list(progress_box, items_list: list[str]) -> None:
+    """Render retrieval progress messages as a compact list into the given placeholder."""
+    if not items_list:
+        progress_box.empty()
+        return
+    items_html = "".join(f"<li><span style='color:#6b7280;'>{_esc_html(m)}</span></li>" for m in items_list)
+    progress_box.markdown(
+        f"<ul style='margin:0.25rem 0 0.5rem 1.25rem;padding:0;'>{items_html}</ul>",
+        unsafe_allow_html=True,
+    )
+
+
+def _rows_to_arrow(rows):
+    """Materialize SQLAlchemy rows into a compact pyarrow Table for the session cache.
+
+    Falls back to the original rows when pyarrow is unavailable or a column has
+    mixed types that Arrow cannot infer.
+    """
+    try:
+        import pyarrow as pa
+        # Column-wise build: no per-row dicts, and duplicate column names survive
+        names = list(rows[0]._mapping.keys())
+        arrays = [pa.array(col) for col in zip(*rows)]
+        return pa.Table.from_arrays(arrays, names=names)
+    except Exception:
+        return rows
+
+
+@st.cache_data(show_spinner=False)
+def _describe_sql_cached(sql: str, _svc) -> str:
+    """Memoized SQL description; the SQL text is immutable once retrieved."""
+    return _svc.describe_sql(sql)
+
+
+def _batch_tab_label(item: dict, svc) -> str:
+    """Build the short tab label for one retrieved batch item."""
+    rows = item.get('rows') or []
+    error = item.get('error')
+    # Prefer a human-friendly description of the SQL
+    sql = item.get('sql') or ""
+    try:
+        desc = _describe_sql_cached(sql, svc).strip()
+    except Exception:
+        desc = "Retrieved data"
+    base = desc if desc else "Retrieved data"
+    label = f"{base} (Error)" if error else f"{base} ({len(rows)})"
+    # Keep labels reasonably short for tabs
+    if len(label) > 70:
+        label = label[:67] + "…"
+    return label
+
+
+@st.cache_resource(show_spinner=False)
+def _get_llm_service(db_path: str, key_fp: str, _key: str | None):
+    """Reuse one LLMService per database; provider settings are re-read live on each call."""
+    return LLMService(db_engine=get_cached_engine(db_path, _key))
+
+
+@st.cache_data(ttl=300, max_entries=64, show_spinner=False)
+def _patient_context(db_path: str, key_fp: str, data_version: int, _key: str | None):
+    """Demographics for the Data tab, cached until the importer bumps `data_version`."""
+    return _get_llm_service(db_path, key_fp, _key).get_patient_context()
+
+
+def _item_to_df(item: dict) -> "pd.DataFrame":
+    """DataFrame for one retrieved batch item (Arrow table when available)."""
+    # Imported lazily: only needed once there is retrieved data to show
+    import pandas as pd
+    rows = item.get('rows') or []
+    table = item.get('table')
+    if hasattr(table, "to_pandas"):
+        # Keep Arrow-backed columns so st.dataframe can hand them back without conversion
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+    if hasattr(rows[0], "_mapping"):
+        # Build straight from the row mappings; no intermediate tuple copy
+        cols = list(rows[0]._mapping.keys())
+        return pd.DataFrame.from_records([r._mapping for r in rows], columns=cols)
+    return pd.DataFrame.from_records(rows)
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _batch_item_df(batch_id: str, idx: int, _item: dict) -> "pd.DataFrame":
+    """Memoized `_item_to_df`; a batch is immutable once `last_batch_id` is assigned."""
+    return _item_to_df(_item)
+
+
+@st.fragment
+def _conversation_controls(svc) -> None:
+    """Reset / Consult buttons.
+
+    A click reruns only this fragment; once the conversation changes the
+    handler triggers a full rerun so the history picks it up.
+    """
+    col1_a, col1_b = st.columns(2)
+    with col1_a:
+        if st.button("Reset conversation"):
+            st.session_state['chat_history'] = []
+            st.session_state['last_user_idx'] = None
+            st.session_state['show_full_history'] = False
+            st.session_state['last_sql'] = None
+            st.session_state['last_rows'] = None
+            st.session_state['last_batch'] = None
+            st.session_state['first_ok_idx'] = None
+            st.session_state['pending_question'] = None
+            st.session_state['consult_ready'] = False
+            st.session_state['rows_history'] = []
+            st.session_state['sql_history'] = []
+            st.session_state['batch_history'] = []
+            # The next reply starts a new autosaved conversation
+            st.session_state['autosave_conv_id'] = None
+            st.session_state['autosave_title'] = None
+            st.session_state['autosaved_len'] = 0
+            # Forget the loaded conversation and its selection together; dropping only the id
+            # would reload the still-selected conversation on the next run
+            st.session_state.pop('_loaded_conv_id', None)
+            st.session_state.pop('load_conv_select', None)
+            st.rerun()
+
+    with col1_b:
+        # Offer Consult action when rows are ready
+        if st.session_state.get('consult_ready') and st.session_state.get('pending_question'):
+            if st.button("Consult", type="primary", key="consult_btn"):
+                try:
+                    # Use the full chat history and the most recent retrieved data
+                    rows_history = _bounded_rows(st.session_state.get('rows_history') or [])
+                    # Stream the reply as it is generated
+                    placeholder = st.empty()
+                    answer = placeholder.write_stream(
+                        svc.consult_conversation_stream(st.session_state['chat_history'], rows_history)
+                    )
+                    st.session_state['chat_history'].append({"role": "assistant", "content": answer})
+                    _maybe_autosave()
+                    # Ask UI to scroll to the latest assistant message
+                    st.session_state['assistant_version'] += 1
+                    # Clear pending state but keep last retrieval visible in the other tab
+                    st.session_state['pending_question'] = None
+                    st.session_state['consult_ready'] = False
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"An error occurred during consultation: {e}")
+
+
+@st.fragment
+def _render_data_panel(db_path: str, db_key: str | None, svc) -> None:
+    """Patient context and the tabs for the latest retrieved batch."""
+    # Patient context
+    with st.container(border=True):
+        st.subheader("Patient Context")
+        ctx = _patient_context(db_path, key_fingerprint(db_key), int(st.session_state.get('data_version', 0)), db_key)
+        if ctx:
+            info_col1, info_col2 = st.columns(2)
+            info_col1.metric("Age", ctx.get("age", "—"))
+            info_col2.metric("Gender", ctx.get("gender", "—"))
+            info_col1.metric("Race", ctx.get("race", "—"))
+            info_col2.metric("Ethnicity", ctx.get("ethnicity", "—"))
+            st.metric("DOB", ctx.get("dob", "—"))
+        else:
+            st.caption("No demographics available.")
+
+    st.markdown("---")
+    st.subheader("Retrieved Data")
+    batch = st.session_state.get('last_batch')
+
+    if batch:
+        # Labels are computed once at retrieval time; fall back for older batches
+        tab_labels = [item.get('label') or _batch_tab_label(item, svc) for item in batch]
+
+        tabs = st.tabs(tab_labels)
+        for i, tab in enumerate(tabs):
+            with tab:
+                item = batch[i]
+                sql = item.get('sql')
+                rows = item.get('rows') or []
+                error = item.get('error')
+
+                if error:
+                    st.error(f"An error occurred in this query:\n\n{error}")
+                elif rows:
+                    batch_id = st.session_state.get('last_batch_id')
+                    # Every tab body runs on each rerun; only build DataFrames the user asks for
+                    if st.toggle(f"Show {len(rows)} row(s)", value=(i == 0), key=f"t{batch_id}_{i}"):
+                        try:
+                            df = _batch_item_df(batch_id, i, item) if batch_id else _item_to_df(item)
+                            st.dataframe(df, use_container_width=True, hide_index=True)
+                        except Exception as e:
+                            st.text("\n".join(str(r) for r in rows[:50]))
+                            st.error(f"Could not render DataFrame: {e}")
+                else:
+                    st.caption("No rows returned for this query.")
+
+                if sql:
+                    with st.expander("View SQL Query"):
+                        st.code(sql, language="sql")
+    else:
+        st.info("No data retrieved yet. Ask a question to see relevant records.")
+
+
+def _queue_config_write(updates: dict) -> None:
+    """Queue config updates; they are written once by `_flush_pending_config` at the end of the run."""
+    pending = st.session_state.setdefault('_pending_config', {})
+    pending.update(updates)
+    st.session_state['_cfg_dirty'] = True
+
+
+def _flush_pending_config() -> None:
+    """Persist any queued config updates in a single write."""
+    if not st.session_state.get('_cfg_dirty'):
+        return
+    pending = st.session_state.get('_pending_config') or {}
+    try:
+        if pending:
+            save_configuration(pending)
+        st.session_state['_pending_config'] = {}
+        st.session_state['_cfg_dirty'] = False
+    except Exception:
+        # Keep the queue so the next run retries the write
+        pass
+
+
+def _bounded_rows(history: list, max_items: int = 5, max_cells: int = 20000) -> list:
+    """Most recent retrievals that fit the consult budget, oldest first.
+
+    Walks backwards keeping at most `max_items` result sets and stops once the
+    estimated cell count (rows x columns) would exceed `max_cells`. The newest
+    result set is always kept so the current question has data.
+    """
+    acc = []
+    total = 0
+    for rs in reversed(history or []):
+        if len(acc) >= max_items:
+            break
+        try:
+            if hasattr(rs, "num_rows"):
+                cells = rs.num_rows * rs.num_columns
+            else:
+                cells = len(rs) * (len(rs[0]) if rs else 0)
+        except Exception:
+            cells = 0
+        if acc and total + cells > max_cells:
+            break
+        total += cells
+        acc.append(rs)
+    return list(reversed(acc))
+
+
+def _find_last_user_idx(messages: list[dict]) -> int | None:
+    """Index of the latest user message, or None if there is none."""
+    return next((i for i in range(len(messages) - 1, -1, -1) if messages[i].get('role') == 'user'), None)
+
+
+def _render_message(i: int, msg: dict) -> None:
+    """Render one chat message, with an anchor and disclaimer for assistant replies."""
+    role = msg.get('role', 'user')
+    # Inject a small anchor before assistant messages to allow scrolling
+    if role == 'assistant':
+        st.markdown(f'<a id="assistant-msg-{i}"></a>', unsafe_allow_html=True)
+    with st.chat_message(role):
+        # Prepend a small, styled disclaimer for assistant responses
+        if role == 'assistant':
+            st.markdown(_DISCLAIMER_HTML, unsafe_allow_html=True)
+        st.markdown(msg.get('content', ''))
+
+
+@st.fragment
+def _render_history(chat_hist: list[dict], last_user_idx: int | None) -> None:
+    """Render the settled part of the conversation (everything before the latest user turn).
+
+    The latest user message is rendered by the caller because the live retrieval
+    progress and auto-consult stream are attached under it.
+    """
+    end = len(chat_hist) if last_user_idx is None else last_user_idx
+    # Long conversations: only the most recent window is rendered unless expanded
+    start = 0
+    if end > _HISTORY_WINDOW and not st.session_state.get('show_full_history'):
+        start = end - _HISTORY_WINDOW
+        if st.button(f"Show {start} earlier message(s)", key="show_full_history_btn"):
+            st.session_state['show_full_history'] = True
+            start = 0
+    for i in range(start, end):
+        _render_message(i, chat_hist[i])
+
+@st.fragment
+def _conversation_sidebar(llm_service) -> None:
+    """Load, save and delete saved conversations from the sidebar.
+
+    Runs as a fragment so picking entries in the selectboxes doesn't rerun the
+    whole page; actions that change the visible conversation trigger a full rerun.
+    """
+    st.subheader("Conversations")
+
+    username = st.session_state.get("username")
+    key = st.session_state.get("db_encryption_key")
+
+    if not (username and key):
+        st.warning("Login required to manage conversations.")
+        convs = []
+    else:
+        convs = _cached_list_conversations(username, key_fingerprint(key), key)
+
+    # Options are conversation ids; titles are looked up for display only.
+    # Rebuild the lookup only when the (id, title) list actually changed.
+    sig = hash(tuple((c['id'], c['title']) for c in convs))
+    if st.session_state.get('_conv_sig') != sig:
+        st.session_state['_conv_by_id'] = {c['id']: c for c in convs}
+        st.session_state['_conv_sig'] = sig
+    convs_by_id = st.session_state['_conv_by_id']
+    sel_id = st.selectbox(
+        "Load a conversation",
+        options=list(convs_by_id),
+        format_func=lambda cid: f"{convs_by_id[cid]['title']} ({cid})",
+        index=None,
+        placeholder="Select…",
+        key="load_conv_select",
+    )
+
+    # Load once per selection; the selectbox keeps its value across reruns
+    if sel_id and sel_id != st.session_state.get('_loaded_conv_id'):
+        st.session_state['_loaded_conv_id'] = sel_id
+        data = load_conversation(sel_id, username, key)
+        if data and data.get("messages"):
+            st.session_state['chat_history'] = data["messages"]
+            # Further replies are autosaved back into the loaded conversation
+            st.session_state['autosave_conv_id'] = sel_id
+            st.session_state['autosave_title'] = data.get('title')
+            st.session_state['autosaved_len'] = len(data["messages"])
+            st.session_state['last_user_idx'] = _find_last_user_idx(data["messages"])
+            st.session_state['show_full_history'] = False
+            st.session_state['last_sql'] = None
+            st.session_state['last_rows'] = None
+            st.session_state['pending_question'] = None
+            st.session_state['consult_ready'] = False
+            st.session_state['last_batch'] = None
+            st.session_state['first_ok_idx'] = None
+            st.session_state['rows_history'] = []
+            # Restore saved SQL history (if available) and rebuild rows for context
+            st.session_state['sql_history'] = data.get('sql_history', [])
+            st.session_state['batch_history'] = data.get('batches') or []
+            rebuilt = 0
+            if st.session_state['batch_history']:
+                # Saved snapshots: no SQL replay or relabeling needed
+                snaps = st.session_state['batch_history']
+                st.session_state['rows_history'] = [b['table'] for b in snaps]
+                rebuilt = len(snaps)
+                last_turn = snaps[-1].get('turn')
+                st.session_state['last_batch_id'] = uuid.uuid4().hex
+                st.session_state['last_batch'] = [
+                    {"sql": b.get('sql'), "rows": b['table'], "table": b['table'], "label": b.get('label'), "error": None}
+                    for b in snaps if b.get('turn') == last_turn
+                ]
+                # Snapshots only hold successful retrievals
+                st.session_state['first_ok_idx'] = 0 if st.session_state['last_batch'] else None
+            elif st.session_state['sql_history']:
+                # Legacy saves without snapshots: rebuild rows by re-running the SQL
+                def _replay_sql(clean: str):
+                    # Runs in a worker thread: no st.* calls here
+                    try:
+                        if not clean:
+                            return None
+                        return llm_service.execute_sql(clean)
+                    except Exception:
+                        return None
+
+                with st.spinner("Rebuilding retrieved data from saved SQL…"):
+                    # Normalize all statements up front (one patient-id lookup for the batch)
+                    _sqls = llm_service.sanitize_and_inline_many(st.session_state['sql_history'])
+                    # Independent read-only queries; run concurrently, keep original order
+                    with ThreadPoolExecutor(max_workers=min(8, len(_sqls))) as _ex:
+                        _replayed = list(_ex.map(_replay_sql, _sqls))
+                    for rows in _replayed:
+                        if rows:
+                            st.session_state['rows_history'].append(_rows_to_arrow(rows))
+                            rebuilt += 1
+            # After loading, position the view at the last assistant message (if any)
+            st.session_state['assistant_version'] += 1
+            st.session_state['_conv_load_notice'] = rebuilt
+            # The conversation lives outside this fragment: rerun the whole page
+            st.rerun()
+    if st.session_state.get('_conv_load_notice') is not None:
+        rebuilt = st.session_state.pop('_conv_load_notice')
+        st.success("Conversation loaded.")
+        if rebuilt:
+            st.caption(f"Restored {rebuilt} data set(s) for context.")
+
+    with st.form("save_conv_form", clear_on_submit=True):
+        title = st.text_input("Title", value="")
+        save_clicked = st.form_submit_button("Save conversation")
+        if save_clicked:
+            if st.session_state['chat_history'] and username and key:
+                # Save over the autosaved copy (if any) so there is one file per conversation
+                title = title or st.session_state.get('autosave_title')
+                with _AUTOSAVE_LOCK:
+                    conv_id = save_conversation(
+                        st.session_state['chat_history'],
+                        username,
+                        key,
+                        title=title or None,
+                        conv_id=st.session_state.get('autosave_conv_id'),
+                        sql_history=st.session_state.get('sql_history') or [],
+                        batches=st.session_state.get('batch_history') or [],
+                    )
+                st.session_state['autosave_conv_id'] = conv_id
+                st.session_state['autosave_title'] = title or None
+                st.session_state['autosaved_len'] = len(st.session_state['chat_history'])
+                st.success(f"Saved as {conv_id}")
+                _cached_list_conversations.clear()
+                # Only the conversation list changed; refresh just this fragment
+                st.rerun(scope="fragment")
+            elif not (username and key):
+                st.error("You must be logged in to save conversations.")
+            else:
+                st.info("Nothing to save yet.")
+
+    # Delete helper
+    if convs_by_id:
+        del_choice = st.selectbox("Delete conversation", options=["—"] + list(convs_by_id), index=0)
+        if del_choice and del_choice != "—":
+            if st.button("Delete selected"):
+                if username:
+                    delete_conversation(del_choice, username)
+                    if del_choice == st.session_state.get('autosave_conv_id'):
+                        st.session_state['autosave_conv_id'] = None
+                    _cached_list_conversations.clear()
+                    st.rerun(scope="fragment")
+                else:
+                    st.error("You must be logged in to delete conversations.")
+
+
 # Check user authentication
 check_auth()
 
@@ -31,14 +539,20 @@ if not st.session_state.get('data_imported', False):
 else:
     # If data has been imported, show the conversational explorer
     db_path = st.session_state.get('db_path', 'mychart.db')
-    engine = get_db_engine(db_path, key=st.session_state.get('db_encryption_key'))
+    db_key = st.session_state.get('db_encryption_key')
+    engine = get_cached_engine(db_path, db_key)
+    # Sessions are stateful; create one per rerun from the cached engine
     session = get_session(engine)
-    llm_service = LLMService(db_engine=engine)
+    llm_service = _get_llm_service(db_path, key_fingerprint(db_key), db_key)
 
     # Initialize chat history and last retrieval in session_state
     st.session_state.setdefault('chat_history', [])  # list of {role, content}
     st.session_state.setdefault('last_sql', None)
     st.session_state.setdefault('last_rows', None)
+    st.session_state.setdefault('first_ok_idx', None)
+    st.session_state.setdefault('autosave_conv_id', None)
+    st.session_state.setdefault('autosave_title', None)
+    st.session_state.setdefault('autosaved_len', 0)
     st.session_state.setdefault('last_batch', None)  # list of {sql, rows, error}
     st.session_state.setdefault('pending_question', None)
     st.session_state.setdefault('consult_ready', False)
@@ -48,13 +562,19 @@ else:
     st.session_state.setdefault('rows_history', [])  # list[list[row]]
     # Persist successful SQL statements to allow reconstruction when loading a saved conversation
     st.session_state.setdefault('sql_history', [])  # list[str]
+    # Labeled row snapshots ({sql, label, turn, table}) saved with the conversation
+    st.session_state.setdefault('batch_history', [])
     # Retrieval progress messages for the current question
     st.session_state.setdefault('progress_msgs', [])
     # Per-turn retrieval token guard
     st.session_state.setdefault('retrieval_token', 0)
     st.session_state.setdefault('retrieval_processed_token', 0)
-    # UI: whether to scroll to the last assistant message on rerun
-    st.session_state.setdefault('scroll_to_last_assistant', False)
+    # Index of the latest user message; maintained on append/load/reset instead of rescanning
+    if 'last_user_idx' not in st.session_state:
+        st.session_state['last_user_idx'] = _find_last_user_idx(st.session_state['chat_history'])
+    # UI: scroll to the last assistant message only when a new one was added since the last scroll
+    st.session_state.setdefault('assistant_version', 0)
+    st.session_state.setdefault('scrolled_version', -1)
 
     # Sidebar: conversation management and backend selection
     with st.sidebar:
@@ -93,7 +613,7 @@ else:
                 st.warning("OpenRouter isn't configured yet. Add your API key in Settings, or request a temporary API key by emailing kc@mychartexplorer.com.")
                 return
             # Persist only the valid provider; avoid mutating unrelated widget state
-            save_configuration({"llm_provider": st.session_state["llm_provider"]})
+            _queue_config_write({"llm_provider": st.session_state["llm_provider"]})
             st.session_state["_prev_llm_provider"] = st.session_state["llm_provider"]
             # A toast is fine; Streamlit reruns after callbacks automatically
             st.toast(f"Backend: {st.session_state['llm_provider'].capitalize()}")
@@ -131,89 +651,25 @@ else:
         auto_on = st.checkbox("Automatically consult after retrieval", value=prev_auto, help="When enabled, the assistant will respond immediately after data is retrieved.")
         if auto_on != prev_auto:
             st.session_state["auto_consult"] = auto_on
-            # Persist to config
-            save_configuration({"auto_consult": auto_on})
+            # Persist to config (written once at the end of this run)
+            _queue_config_write({"auto_consult": auto_on})
+
+        prev_autosave = bool(st.session_state.get("autosave_conversations", False))
+        autosave_on = st.checkbox(
+            "Autosave conversations",
+            value=prev_autosave,
+            help="Save the open conversation (including retrieved records) to your encrypted conversation store in the background after each reply. Off by default.",
+        )
+        if autosave_on != prev_autosave:
+            st.session_state["autosave_conversations"] = autosave_on
+            _queue_config_write({"autosave_conversations": autosave_on})
+        autosave_error = (st.session_state.get('_autosave_status') or {}).get('error')
+        if autosave_on and autosave_error:
+            st.warning(f"Autosave failed: {autosave_error}. It will retry after the next reply; use 'Save conversation' to keep it now.")
 
         st.markdown("---")
 
-        st.subheader("Conversations")
-        
-        username = st.session_state.get("username")
-        key = st.session_state.get("db_encryption_key")
-
-        if not (username and key):
-            st.warning("Login required to manage conversations.")
-            convs = []
-        else:
-            convs = list_conversations(username, key)
-
-        options = [f"{c['title']} ({c['id']})" for c in convs]
-        selected = st.selectbox("Load a conversation", options=options, index=None, placeholder="Select…")
-        
-        if selected:
-            # Extract id from trailing parentheses
-            sel_id = selected.split("(")[-1].rstrip(")")
-            data = load_conversation(sel_id, username, key)
-            if data and data.get("messages"):
-                st.session_state['chat_history'] = data["messages"]
-                st.session_state['last_sql'] = None
-                st.session_state['last_rows'] = None
-                st.session_state['pending_question'] = None
-                st.session_state['consult_ready'] = False
-                st.session_state['last_batch'] = None
-                st.session_state['rows_history'] = []
-                # Restore saved SQL history (if available) and rebuild rows for context
-                st.session_state['sql_history'] = data.get('sql_history', [])
-                rebuilt = 0
-                if st.session_state['sql_history']:
-                    with st.spinner("Rebuilding retrieved data from saved SQL…"):
-                        for _sql in st.session_state['sql_history']:
-                            try:
-                                clean = llm_service._sanitize_sql(_sql)
-                                clean = llm_service._inline_patient_id(clean)
-                                if not clean:
-                                    continue
-                                rows = llm_service.execute_sql(clean)
-                                if rows:
-                                    st.session_state['rows_history'].append(rows)
-                                    rebuilt += 1
-                            except Exception:
-                                continue
-                st.success("Conversation loaded.")
-                if rebuilt:
-                    st.caption(f"Restored {rebuilt} data set(s) for context.")
-                # After loading, position the view at the last assistant message (if any)
-                st.session_state['scroll_to_last_assistant'] = True
-        
-        with st.form("save_conv_form", clear_on_submit=True):
-            title = st.text_input("Title", value="")
-            save_clicked = st.form_submit_button("Save conversation")
-            if save_clicked:
-                if st.session_state['chat_history'] and username and key:
-                    conv_id = save_conversation(
-                        st.session_state['chat_history'],
-                        username,
-                        key,
-                        title=title or None,
-                        sql_history=st.session_state.get('sql_history') or [],
-                    )
-                    st.success(f"Saved as {conv_id}")
-                    st.rerun()
-                elif not (username and key):
-                    st.error("You must be logged in to save conversations.")
-                else:
-                    st.info("Nothing to save yet.")
-        
-        # Delete helper
-        if convs:
-            del_choice = st.selectbox("Delete conversation", options=["—"] + [c['id'] for c in convs], index=0)
-            if del_choice and del_choice != "—":
-                if st.button("Delete selected"):
-                    if username:
-                        delete_conversation(del_choice, username)
-                        st.rerun()
-                    else:
-                        st.error("You must be logged in to delete conversations.")
+        _conversation_sidebar(llm_service)
 
     # Note: Retrieval is now executed inline under the last user message in the Conversation tab
 
@@ -222,61 +678,47 @@ else:
 
     with tab_conv:
         st.subheader("Conversation")
-        # Render history with anchor ids for assistant messages
-        last_assistant_anchor = None
-        chat_hist = st.session_state['chat_history']
-        # Determine the latest user message index (to attach progress under it)
-        last_user_idx = None
-        for _i in range(len(chat_hist) - 1, -1, -1):
-            if chat_hist[_i].get('role') == 'user':
-                last_user_idx = _i
-                break
-
-        prog = st.session_state.get('progress_msgs') or []
-
-        for i, msg in enumerate(chat_hist):
-            role = msg.get('role', 'user')
-            # Inject a small anchor before assistant messages to allow scrolling
-            if role == 'assistant':
-                anchor_id = f"assistant-msg-{i}"
-                # invisible anchor
-                st.markdown(f'<a id="{anchor_id}"></a>', unsafe_allow_html=True)
-                last_assistant_anchor = anchor_id
-            with st.chat_message(role):
-                # Prepend a small, styled disclaimer for assistant responses
-                if role == 'assistant':
-                    st.markdown(
-                        (
-                            "<div style=\"font-size:0.85rem; line-height:1.25rem; color:#7c2d12; "
-                            "background:#fff7ed; border:1px solid #fdba74; padding:8px 10px; "
-                            "border-radius:8px; margin:0 0 6px 0;\">"
-                            "<strong>Not medical advice:</strong> The assistant's response is for informational purposes only. "
-                            "Always consult a qualified clinician for medical advice."
-                            "</div>"
-                        ),
-                        unsafe_allow_html=True,
-                    )
-                st.markdown(msg.get('content', ''))
-                # If this is the most recent user message, show the current progress right after it
-                if last_user_idx is not None and i == last_user_idx:
+        # Reserve the conversation area above the input so a submitted question can
+        # be staged before the history renders
+        conv_area = st.container()
+
+        # Input
+        user_input = st.chat_input("Ask about your health data…")
+        if user_input:
+            # Stage the question; the conversation area below renders it and starts
+            # retrieval in this same run, so no extra st.rerun() is needed
+            st.session_state['pending_question'] = user_input
+            st.session_state['last_sql'] = None
+            st.session_state['last_rows'] = None
+            st.session_state['last_batch'] = None
+            st.session_state['first_ok_idx'] = None
+            st.session_state['consult_ready'] = False
+            st.session_state['chat_history'].append({"role": "user", "content": user_input})
+            st.session_state['last_user_idx'] = len(st.session_state['chat_history']) - 1
+            st.session_state['should_start_retrieval'] = True
+            # Increment per-turn token to signal new retrieval
+            try:
+                st.session_state['retrieval_token'] = int(st.session_state.get('retrieval_token', 0)) + 1
+            except Exception:
+                st.session_state['retrieval_token'] = 1
+
+        with conv_area:
+            chat_hist = st.session_state['chat_history']
+            # Latest user message index (to attach progress under it)
+            last_user_idx = st.session_state.get('last_user_idx')
+
+            prog = st.session_state.get('progress_msgs') or []
+
+            _render_history(chat_hist, last_user_idx)
+
+            # The latest user turn is rendered outside the fragment: retrieval mutates
+            # top-level session state and streams progress directly under the message.
+            if last_user_idx is not None:
+                with st.chat_message('user'):
+                    st.markdown(chat_hist[last_user_idx].get('content', ''))
                     # Create a live placeholder for progress messages directly under the user message
                     progress_box = st.empty()
 
-                    def _esc_html2(s: str) -> str:
-                        return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-                    def _render_progress_list(items_list: list[str]):
-                        if not items_list:
-                            progress_box.empty()
-                            return
-                        items_html = "".join(f"<li><span style='color:#6b7280;'>{_esc_html2(m)}</span></li>" for m in items_list)
-                        progress_box.markdown(
-                            f"<ul style='margin:0.25rem 0 0.5rem 1.25rem;padding:0;'>{items_html}</ul>",
-                            unsafe_allow_html=True,
-                        )
-                        # Brief sleep to allow Streamlit UI to paint incrementally
-                        time.sleep(0.03)
-
                     # If a retrieval is queued, run it now and stream progress in real time
                     if (st.session_state.get('should_start_retrieval') and
                         st.session_state.get('pending_question') and
@@ -294,7 +736,7 @@ else:
 
                         def _progress(msg: str):
                             st.session_state['progress_msgs'].append(str(msg))
-                            _render_progress_list(st.session_state['progress_msgs'])
+                            _render_progress_list(progress_box, st.session_state['progress_msgs'])
 
                         try:
                             _progress("Starting retrieval…")
@@ -303,33 +745,56 @@ else:
                                 max_queries=4,
                                 max_retries=1,
                                 progress_cb=_progress,
-                                chat_history=st.session_state.get('chat_history')
+                                chat_history=st.session_state.get('chat_history'),
+                                concurrency=4,
                             )
                             st.session_state['last_batch'] = batch
-                            first_ok = next((r for r in batch if r.get('rows')), None) if batch else None
-                            st.session_state['last_sql'] = first_ok.get('sql') if first_ok else None
-                            st.session_state['last_rows'] = first_ok.get('rows') if first_ok else None
-                            st.session_state['consult_ready'] = True
-                            # Append successful rows and SQL to histories
+                            st.session_state['last_batch_id'] = uuid.uuid4().hex
+                            # Single pass: label items, append successful rows/SQL to histories,
+                            # and remember where the first successful item is
+                            first_ok_idx = None
                             try:
-                                for item2 in (batch or []):
+                                for idx2, item2 in enumerate(batch or []):
+                                    item2['label'] = _batch_tab_label(item2, llm_service)
                                     rows2 = item2.get('rows') or []
                                     if rows2:
-                                        st.session_state['rows_history'].append(rows2)
+                                        if first_ok_idx is None:
+                                            first_ok_idx = idx2
+                                        # Keep the Arrow copy on the item so the Data tab can reuse it
+                                        item2['table'] = _rows_to_arrow(rows2)
+                                        st.session_state['rows_history'].append(item2['table'])
+                                        st.session_state['batch_history'].append({
+                                            "sql": item2.get('sql'),
+                                            "label": item2['label'],
+                                            "turn": last_user_idx,
+                                            "table": item2['table'],
+                                        })
                                         sql2 = item2.get('sql')
                                         if sql2:
                                             st.session_state['sql_history'].append(sql2)
                             except Exception:
                                 pass
+                            st.session_state['first_ok_idx'] = first_ok_idx
+                            first_ok = batch[first_ok_idx] if first_ok_idx is not None else None
+                            st.session_state['last_sql'] = first_ok.get('sql') if first_ok else None
+                            st.session_state['last_rows'] = first_ok.get('rows') if first_ok else None
+                            st.session_state['consult_ready'] = True
                             # Optionally consult immediately
                             if st.session_state.get('auto_consult', True) and st.session_state.get('pending_question'):
                                 try:
-                                    rows_history = st.session_state.get('rows_history') or []
-                                    # Show a spinner while the LLM composes its reply
-                                    with st.spinner("Thinking …"):
-                                        answer = llm_service.consult_conversation(st.session_state['chat_history'], rows_history)
+                                    # Only the most recent retrievals go into the prompt
+                                    rows_history = _bounded_rows(st.session_state.get('rows_history') or [])
+                                    # Stream the reply as it is generated
+                                    placeholder = st.empty()
+                                    answer = placeholder.write_stream(
+                                        llm_service.consult_conversation_stream(st.session_state['chat_history'], rows_history)
+                                    )
+                                    # The live stream sits under the user's bubble; the tail loop below
+                                    # draws the stored reply as an assistant message (with disclaimer)
+                                    placeholder.empty()
                                     st.session_state['chat_history'].append({"role": "assistant", "content": answer})
-                                    st.session_state['scroll_to_last_assistant'] = True
+                                    _maybe_autosave()
+                                    st.session_state['assistant_version'] += 1
                                     st.session_state['pending_question'] = None
                                     st.session_state['consult_ready'] = False
                                 except Exception as e:
@@ -341,141 +806,37 @@ else:
 
                     # Always render any existing progress list (will be updated live during retrieval)
                     prog = st.session_state.get('progress_msgs') or []
-                    _render_progress_list(prog)
-
-        # If requested, scroll to the last assistant anchor after render
-        if st.session_state.get('scroll_to_last_assistant') and last_assistant_anchor:
-            components.html(
-                f"""
-                <script>
-                const el = document.getElementById('{last_assistant_anchor}');
-                if (el) {{ el.scrollIntoView({{ behavior: 'smooth', block: 'center' }}); }}
-                </script>
-                """,
-                height=0,
-            )
-            # Reset the flag
-            st.session_state['scroll_to_last_assistant'] = False
-
-        # Input
-        user_input = st.chat_input("Ask about your health data…")
-        if user_input:
-            # Stage the question and rerun so the message is visible before retrieval starts
-            st.session_state['pending_question'] = user_input
-            st.session_state['last_sql'] = None
-            st.session_state['last_rows'] = None
-            st.session_state['last_batch'] = None
-            st.session_state['consult_ready'] = False
-            st.session_state['chat_history'].append({"role": "user", "content": user_input})
-            st.session_state['should_start_retrieval'] = True
-            # Increment per-turn token to signal new retrieval
-            try:
-                st.session_state['retrieval_token'] = int(st.session_state.get('retrieval_token', 0)) + 1
-            except Exception:
-                st.session_state['retrieval_token'] = 1
-            st.rerun()
+                    _render_progress_list(progress_box, prog)
+
+            # Messages after the latest user turn (e.g. the reply for this turn)
+            tail_start = len(chat_hist) if last_user_idx is None else last_user_idx + 1
+            for i in range(tail_start, len(chat_hist)):
+                _render_message(i, chat_hist[i])
+
+            # Scroll to the last assistant anchor only when a new assistant message exists
+            scroll_pending = st.session_state['assistant_version'] != st.session_state['scrolled_version']
+            last_assistant_anchor = next(
+                (f"assistant-msg-{i}" for i in range(len(chat_hist) - 1, -1, -1) if chat_hist[i].get('role') == 'assistant'),
+                None,
+            ) if scroll_pending else None
+            if scroll_pending and last_assistant_anchor:
+                components.html(
+                    f"""
+                    <script>
+                    const el = document.getElementById('{last_assistant_anchor}');
+                    if (el) {{ el.scrollIntoView({{ behavior: 'smooth', block: 'center' }}); }}
+                    </script>
+                    """,
+                    height=0,
+                )
+                st.session_state['scrolled_version'] = st.session_state['assistant_version']
 
         # Controls
-        col1_a, col1_b = st.columns(2)
-        with col1_a:
-            if st.button("Reset conversation"):
-                st.session_state['chat_history'] = []
-                st.session_state['last_sql'] = None
-                st.session_state['last_rows'] = None
-                st.session_state['last_batch'] = None
-                st.session_state['pending_question'] = None
-                st.session_state['consult_ready'] = False
-                st.session_state['rows_history'] = []
-                st.session_state['sql_history'] = []
-                st.rerun()
-
-        with col1_b:
-            # Offer Consult action when rows are ready
-            if st.session_state.get('consult_ready') and st.session_state.get('pending_question'):
-                if st.button("Consult", type="primary", key="consult_btn"):
-                    try:
-                        # Show a spinner while the LLM composes its reply
-                        with st.spinner("Thinking …"):
-                            # Use the full chat history and all retrieved data so far
-                            rows_history = st.session_state.get('rows_history') or []
-                            answer = llm_service.consult_conversation(st.session_state['chat_history'], rows_history)
-                        st.session_state['chat_history'].append({"role": "assistant", "content": answer})
-                        # Ask UI to scroll to the latest assistant message
-                        st.session_state['scroll_to_last_assistant'] = True
-                        # Clear pending state but keep last retrieval visible in the other tab
-                        st.session_state['pending_question'] = None
-                        st.session_state['consult_ready'] = False
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"An error occurred during consultation: {e}")
+        _conversation_controls(llm_service)
 
     with tab_data:
-        # Patient context
-        with st.container(border=True):
-            st.subheader("Patient Context")
-            ctx = llm_service.get_patient_context()
-            if ctx:
-                info_col1, info_col2 = st.columns(2)
-                info_col1.metric("Age", ctx.get("age", "—"))
-                info_col2.metric("Gender", ctx.get("gender", "—"))
-                info_col1.metric("Race", ctx.get("race", "—"))
-                info_col2.metric("Ethnicity", ctx.get("ethnicity", "—"))
-                st.metric("DOB", ctx.get("dob", "—"))
-            else:
-                st.caption("No demographics available.")
-
-        st.markdown("---")
-        st.subheader("Retrieved Data")
-        batch = st.session_state.get('last_batch')
-
-        if batch:
-            tab_labels = []
-            for idx, item in enumerate(batch):
-                rows = item.get('rows', [])
-                error = item.get('error')
-                # Prefer a human-friendly description of the SQL
-                sql = item.get('sql') or ""
-                try:
-                    desc = llm_service.describe_sql(sql).strip()
-                except Exception:
-                    desc = "Retrieved data"
-                base = desc if desc else "Retrieved data"
-                label = f"{base} (Error)" if error else f"{base} ({len(rows)})"
-                # Keep labels reasonably short for tabs
-                if len(label) > 70:
-                    label = label[:67] + "…"
-                tab_labels.append(label)
-
-            tabs = st.tabs(tab_labels)
-            for i, tab in enumerate(tabs):
-                with tab:
-                    item = batch[i]
-                    sql = item.get('sql')
-                    rows = item.get('rows') or []
-                    error = item.get('error')
-
-                    if error:
-                        st.error(f"An error occurred in this query:\n\n{error}")
-                    elif rows:
-                        try:
-                            import pandas as pd
-                            if hasattr(rows[0], "_mapping"):
-                                cols = list(rows[0]._mapping.keys())
-                                data = [tuple(r) for r in rows]
-                                df = pd.DataFrame(data, columns=cols)
-                            else:
-                                df = pd.DataFrame([tuple(r) for r in rows])
-                            st.dataframe(df, use_container_width=True)
-                        except Exception as e:
-                            st.text("\n".join(str(r) for r in rows[:50]))
-                            st.error(f"Could not render DataFrame: {e}")
-                    else:
-                        st.caption("No rows returned for this query.")
-
-                    if sql:
-                        with st.expander("View SQL Query"):
-                            st.code(sql, language="sql")
-        else:
-            st.info("No data retrieved yet. Ask a question to see relevant records.")
+        _render_data_panel(db_path, db_key, llm_service)
 
     render_footer()
+    # Coalesce any settings toggled during this run into one config write
+    _flush_pending_config()
@@ -2,12 +2,35 @@
 
 import streamlit as st
 from modules.ui import render_footer
-import pandas as pd
-from modules.database import get_db_engine
-from sqlalchemy import inspect
+from modules.engine_cache import get_cached_engine, key_fingerprint
+from sqlalchemy import inspect, text
 from modules.config import load_configuration
 from modules.auth import check_auth
 
+
+@st.cache_data(ttl=120, show_spinner=False)
+def _read_page(db_path: str, key_fp: str, data_version: int, table: str, limit: int, offset: int, _engine) -> "pd.DataFrame":
+    """One page of rows from `table`; cached per (database, import version, table, page)."""
+    # Imported lazily so the "no data imported" path never pays for pandas
+    import pandas as pd
+    # Table names come from the inspector, but still quote them as identifiers
+    quoted = _engine.dialect.identifier_preparer.quote(table)
+    return pd.read_sql_query(
+        text(f"SELECT * FROM {quoted} LIMIT :n OFFSET :o"),
+        _engine,
+        params={"n": int(limit), "o": int(offset)},
+        # Arrow-backed columns go to the browser without another pandas -> Arrow pass
+        dtype_backend="pyarrow",
+    )
+
+
+@st.cache_data(ttl=120, show_spinner=False)
+def _count_rows(db_path: str, key_fp: str, data_version: int, table: str, _engine) -> int:
+    quoted = _engine.dialect.identifier_preparer.quote(table)
+    with _engine.connect() as conn:
+        return int(conn.execute(text(f"SELECT COUNT(*) FROM {quoted}")).scalar() or 0)
+
+
 # Check user authentication
 check_auth()
 
@@ -31,8 +54,8 @@ else:
     st.info(f"Exploring database: `{db_path}`")
 
     try:
-        # Create the database engine
-        engine = get_db_engine(db_path, key=st.session_state.get('db_encryption_key'))
+        # Reuse the shared database engine
+        engine = get_cached_engine(db_path, key=st.session_state.get('db_encryption_key'))
         
         # Use SQLAlchemy's inspector to get table names
         inspector = inspect(engine)
@@ -45,14 +68,24 @@ else:
             selected_table = st.selectbox("Select a table to view:", table_names)
 
             if selected_table:
+                key_fp = key_fingerprint(st.session_state.get('db_encryption_key'))
+                # Bumped by the importer on every write or database removal, so fresh data is never served from cache
+                data_version = int(st.session_state.get('data_version', 0))
+                total_rows = _count_rows(db_path, key_fp, data_version, selected_table, engine)
+                page_col, size_col = st.columns(2)
+                page_size = int(size_col.number_input("Rows per page", min_value=50, max_value=10000, value=500, step=50))
+                page_count = max(1, -(-total_rows // page_size))
+                page = int(page_col.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1))
+
                 # Show a spinner while loading the data
                 with st.spinner(f"Loading data from '{selected_table}'..."):
-                    # Use pandas to read the entire table into a DataFrame
-                    df = pd.read_sql_table(selected_table, engine)
+                    # Only the requested page is read from SQLite
+                    df = _read_page(db_path, key_fp, data_version, selected_table, page_size, (page - 1) * page_size, engine)
                     
                     st.write(f"### Contents of `{selected_table}`")
+                    st.caption(f"{total_rows} row(s) total")
                     # Display the DataFrame in an interactive table
-                    st.dataframe(df)
+                    st.dataframe(df, hide_index=True)
 
     except Exception as e:
         st.error(f"An error occurred while connecting to the database: {e}")
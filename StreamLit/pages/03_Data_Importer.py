@@ -4,27 +4,27 @@
 # Import necessary libraries
 import streamlit as st
 import os
+import time
 import traceback
-from modules.database import get_db_engine, setup_database
-from modules.importer import DataImporter
-from modules.config import load_configuration, get_db_size_limit_mb
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from functools import lru_cache
+from modules.database import setup_database, compact_after_import
+from modules.engine_cache import get_cached_engine
+from modules.importer import DataImporter, parse_xml_to_records
+from modules.config import load_configuration, get_db_size_limit_mb, save_configuration
 from modules.auth import check_auth
 from modules.ui import render_footer
 
-# Capture OAuth callback params early so we don't lose them if auth guard redirects
+# Capture OAuth callback params early so we don't lose them if auth guard redirects.
+# This is the only place query params are read; later code uses session_state.
+# st.query_params values are plain strings (the list-valued API is gone).
 try:
-    try:
-        params = st.query_params  # type: ignore[attr-defined]
-    except Exception:
-        params = st.experimental_get_query_params()  # type: ignore[attr-defined]
-
-    raw_code = params.get('code')
-    raw_state = params.get('state')
-    code_val = raw_code[0] if isinstance(raw_code, list) else raw_code
-    state_val = raw_state[0] if isinstance(raw_state, list) else raw_state
-    if isinstance(code_val, str) and code_val:
+    code_val = st.query_params.get('code') or ''
+    if code_val:
         st.session_state['pending_fhir_code'] = code_val
-        if isinstance(state_val, str) and state_val:
+        state_val = st.query_params.get('state') or ''
+        if state_val:
             st.session_state['pending_fhir_state'] = state_val
         st.info("Received an authorization code from FHIR login. Continue on the Data Importer → SMART tab to exchange it.")
 except Exception:
@@ -42,7 +42,12 @@ load_configuration()
 st.write("Import your health data either by uploading MyChart XML exports or by connecting directly via SMART on FHIR (Epic sandbox). Data is stored privately in your local SQLite database.")
 
 # Initialize a persistent error log in session_state
-st.session_state.setdefault('import_error_logs', [])
+_MAX_ERROR_LOG_ENTRIES = 500
+# Innermost frames kept per logged traceback (deep parser recursion can run to hundreds)
+_LOG_TB_LIMIT = -20
+# Bounded: only the most recent entries are kept for the session
+if not isinstance(st.session_state.get('import_error_logs'), deque):
+    st.session_state['import_error_logs'] = deque(st.session_state.get('import_error_logs') or [], maxlen=_MAX_ERROR_LOG_ENTRIES)
 
 # Determine fixed per-user database path (set at login)
 db_path = st.session_state.get('db_path', 'mychart.db')
@@ -51,11 +56,104 @@ st.info(f"Import will write to your private database: `{db_path}`")
 # Storage threshold (MB) and helpers (admin-controlled)
 db_size_limit_mb = int(get_db_size_limit_mb())
 
+# In-flight OAuth attempts remembered per session (state -> PKCE verifier)
+_MAX_PENDING_VERIFIERS = 16
+
+# Imported files between database size checks during an upload
+_SIZE_CHECK_EVERY = 8
+
 def _db_size_mb(path: str) -> float:
+    """Database size in MB on disk."""
+    # In WAL mode recent writes live in the -wal file until a checkpoint
+    total = 0
+    for p in (path, f"{path}-wal"):
+        try:
+            total += os.path.getsize(p)
+        except Exception:
+            pass
+    return total / (1024 * 1024)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _render_error_log(msgs: tuple[str, ...]) -> tuple[str, bytes]:
+    """(last 100 entries for display, full log for download), joined once per log state."""
+    return "\n\n".join(msgs[-100:]), "\n\n".join(msgs).encode("utf-8")
+
+@st.cache_data(ttl=30, max_entries=64, show_spinner=False)
+def _query_latest_rows(_engine, _model, db_file: str, table: str, columns: tuple[str, ...],
+                       limit: int, newest: bool, stamp: tuple) -> list[dict]:
+    from sqlalchemy import select
+    t = _model.__table__
+    order = t.c.id.desc() if newest else t.c.id.asc()
+    stmt = select(*[t.c[c] for c in columns]).order_by(order).limit(limit)
+    with _engine.connect() as conn:
+        return [dict(r) for r in conn.execute(stmt).mappings()]
+
+def _latest_rows(engine, model, columns: tuple[str, ...], limit: int = 20, newest: bool = True) -> list[dict]:
+    """Display columns of the newest (or oldest) rows of `model`, as plain dicts.
+
+    A Core select of just these columns: no ORM instances or identity map for a preview.
+    Results are reused until the database or its WAL file changes (or 30s pass).
+    """
+    db_file = engine.url.database or ""
+    stamp = []
+    for p in (db_file, f"{db_file}-wal"):
+        try:
+            info = os.stat(p)
+            stamp.append((info.st_mtime_ns, info.st_size))
+        except OSError:
+            stamp.append(None)
+    return _query_latest_rows(engine, model, db_file, model.__tablename__, columns, limit, newest, tuple(stamp))
+
+@st.cache_resource(show_spinner=False)
+def _check_xml_parser() -> bool:
+    """Build a tiny lxml-xml soup once per server process; raises if the parser is missing."""
+    from bs4 import BeautifulSoup
+    BeautifulSoup("<root/>", "lxml-xml")
+    return True
+
+def _show_rows(rows: list[dict]) -> None:
+    """Render preview rows as one DataFrame with the select's column order."""
+    import pandas as pd
+    st.dataframe(pd.DataFrame.from_records(rows, columns=list(rows[0])), hide_index=True)
+
+# Granted scopes that allow reading Immunization
+_IMMUNIZATION_SCOPES = frozenset({
+    'patient/Immunization.read',
+    'patient/*.read',
+    'user/Immunization.read',
+    'user/*.read',
+})
+
+@lru_cache(maxsize=16)
+def _scope_set(scope_str: str) -> frozenset:
+    """Granted scopes as a set, parsed once per distinct token scope string."""
+    return frozenset(scope_str.split())
+
+def _bump_data_version() -> None:
+    """Invalidate page caches keyed on the data version after any write to (or removal of) the database."""
+    st.session_state['data_version'] = int(st.session_state.get('data_version', 0)) + 1
+
+# Minimum seconds between config-file writes of the last sync time
+_SYNC_WRITE_MIN_INTERVAL = 5.0
+
+def _mark_sync_now() -> None:
+    """Record a successful FHIR sync; the config file is written at most every few seconds."""
+    now_iso = datetime.now(timezone.utc).isoformat()
+    st.session_state['last_fhir_sync'] = now_iso
+    now = time.monotonic()
+    if now - st.session_state.get('_last_sync_write', float('-inf')) < _SYNC_WRITE_MIN_INTERVAL:
+        return
+    st.session_state['_last_sync_write'] = now
     try:
-        return os.path.getsize(path) / (1024 * 1024)
+        save_configuration({"last_fhir_sync": now_iso})
     except Exception:
-        return 0.0
+        pass
+
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _discover_smart_cached(base_url: str) -> dict:
+    """SMART discovery document per FHIR base; failures are not cached."""
+    from modules.fhir_client import discover_smart_configuration
+    return discover_smart_configuration(base_url)
 
 if os.path.exists(db_path):
     _cur = _db_size_mb(db_path)
@@ -64,150 +162,170 @@ if os.path.exists(db_path):
 tab_xml, tab_fhir = st.tabs(["MyChart XML Upload", "SMART on FHIR (beta)"])
 
 with tab_xml:
-    # Create a file uploader that accepts multiple files
-    uploaded_files = st.file_uploader("Choose your MyChart XML files", type="xml", accept_multiple_files=True)
-
-    # Check if files have been uploaded
-    if uploaded_files:
+    # Batch the uploader, options and button in a form: the page reruns once on submit
+    with st.form("xml_import_form"):
+        # Create a file uploader that accepts multiple files
+        uploaded_files = st.file_uploader("Choose your MyChart XML files", type="xml", accept_multiple_files=True)
         clear_db = False
         if os.path.exists(db_path):
             clear_db = st.checkbox(f"Clear existing database '{db_path}' before importing.")
-
         # Create a button to start the import process
-    if st.button("Import Data", key="xml_import_data"):
-            if not db_path:
-                st.error("Database file path cannot be empty.")
-            else:
-                # Progress + status containers
-                prog_container = st.container()
-                status_container = st.container()
-                log_container = st.container()
+        submitted = st.form_submit_button("Import Data")
 
-                try:
-                    total = len(uploaded_files)
-                    progress = prog_container.progress(0, text=f"Starting import into {db_path}…")
-                    status_container.info("Preparing database…")
+    if not submitted:
+        st.caption("Upload one or more MyChart .xml exports, then click 'Import Data'.")
+    elif not uploaded_files:
+        st.warning("No files selected yet. Upload one or more MyChart .xml exports to import.")
+    else:
+        if not db_path:
+            st.error("Database file path cannot be empty.")
+        else:
+            # Progress + status containers
+            prog_container = st.container()
+            status_container = st.container()
+            log_container = st.container()
 
-                    # Preflight: ensure the XML parser (lxml-xml) is available
-                    try:
-                        from bs4 import BeautifulSoup as _BS  # type: ignore
-                        _ = _BS("<root/>", "lxml-xml")
-                    except Exception as pe:
-                        status_container.error(
-                            "XML parser 'lxml-xml' is not available. Please install 'lxml' (and 'beautifulsoup4'). "
-                            f"Details: {pe}"
-                        )
-                        st.stop()
+            try:
+                total = len(uploaded_files)
+                progress = prog_container.progress(0, text=f"Starting import into {db_path}…")
+                status_container.info("Preparing database…")
 
-                    # Ensure parent directory exists for user-specific paths
-                    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
-                    if clear_db and os.path.exists(db_path):
-                        os.remove(db_path)
-                        st.toast(f"Removed existing database: {db_path}")
+                # Preflight: ensure the XML parser (lxml-xml) is available
+                try:
+                    _check_xml_parser()
+                except Exception as pe:
+                    status_container.error(
+                        "XML parser 'lxml-xml' is not available. Please install 'lxml' (and 'beautifulsoup4'). "
+                        f"Details: {pe}"
+                    )
+                    st.stop()
 
-                    # Initialize the database
-                    # Optional: support encryption if a passphrase exists in session
-                    db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
-                    setup_database(engine)
-                    # Pre-check current DB size after ensuring file exists
-                    cur_mb = _db_size_mb(db_path)
-                    if cur_mb >= db_size_limit_mb:
-                        status_container.error(
-                            f"Database size {cur_mb:.1f} MB exceeds the limit ({db_size_limit_mb} MB). Import blocked."
-                        )
-                        st.stop()
-                    # Create an DataImporter instance
-                    parser = DataImporter(engine)
-
-                    success_count = 0
-                    file_errors = []
-
-                    # Loop through each uploaded file
-                    import tempfile
-                    for idx, uploaded_file in enumerate(uploaded_files):
-                        fname = uploaded_file.name
-                        # Create a secure temporary file to save the uploaded content
-                        tmp = tempfile.NamedTemporaryFile(prefix="mychart_", suffix=".xml", delete=False)
-                        temp_file_path = tmp.name
+                # Ensure parent directory exists for user-specific paths
+                os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+                # Optional: support encryption if a passphrase exists in session
+                db_key = st.session_state.get('db_encryption_key')
+                if clear_db:
+                    # Close pooled connections to the old file before removing it
+                    get_cached_engine(db_path, key=db_key).dispose()
+                    get_cached_engine(db_path, key=db_key, bulk_import=True).dispose()
+                    removed = False
+                    # WAL side files belong to the old database; never leave them behind
+                    for p in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
                         try:
-                            # Write the uploaded file to the temporary path
-                            with tmp:
-                                tmp.write(uploaded_file.getbuffer())
-
-                            # Parse and import the data from the current file
-                            parser.process_xml_file(temp_file_path)
-                            success_count += 1
-                            # Mid-import size check
-                            cur_mb = _db_size_mb(db_path)
-                            if cur_mb >= db_size_limit_mb:
-                                status_container.warning(
-                                    f"Database reached {cur_mb:.1f} MB, exceeding the limit ({db_size_limit_mb} MB). Import has been stopped."
-                                )
-                                # Update progress to current point and stop processing more files
+                            os.unlink(p)
+                            removed = removed or p == db_path
+                        except FileNotFoundError:
+                            pass
+                    if removed:
+                        st.toast(f"Removed existing database: {db_path}")
+                    # Rows from the old file must not be served from cache, even if the import fails
+                    _bump_data_version()
+
+                # Initialize the database (the import engine allows per-file SAVEPOINTs)
+                engine = get_cached_engine(db_path, key=db_key, bulk_import=True)
+                setup_database(engine)
+                # Pre-check current DB size after ensuring file exists
+                cur_mb = _db_size_mb(db_path)
+                if cur_mb >= db_size_limit_mb:
+                    status_container.error(
+                        f"Database size {cur_mb:.1f} MB exceeds the limit ({db_size_limit_mb} MB). Import blocked."
+                    )
+                    st.stop()
+                # Create an DataImporter instance
+                parser = DataImporter(engine)
+
+                success_count = 0
+                file_errors = []
+
+                def _import_parsed(parsed) -> None:
+                    if parsed is None:
+                        raise ValueError("No patient record (recordTarget/patientRole) found in document")
+                    # Inserts stay on this process so SQLite keeps a single writer
+                    parser.insert_records(parsed)
+
+                # Parse files (CPU-bound) in worker processes; a single file is parsed inline
+                if total > 1:
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor, as_completed
+                    pool = ProcessPoolExecutor(
+                        max_workers=min(os.cpu_count() or 1, total),
+                        # spawn: forking the multi-threaded Streamlit server is unsafe
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+                    futures = {pool.submit(parse_xml_to_records, f.getvalue()): f.name for f in uploaded_files}
+                    parsed_iter = ((futures[fut], fut) for fut in as_completed(futures))
+                else:
+                    pool = None
+                    parsed_iter = ((f.name, f) for f in uploaded_files)
+
+                # At most ~100 progress-bar updates per upload
+                progress_step = max(1, total // 100)
+
+                try:
+                    # One transaction for the whole upload (each file under its own SAVEPOINT)
+                    with parser.transaction():
+                        for idx, (fname, src) in enumerate(parsed_iter):
+                            try:
+                                parsed = src.result() if pool is not None else parse_xml_to_records(src.getvalue())
+                                _import_parsed(parsed)
+                                success_count += 1
+                                # Mid-import size check, every few files (and after the last). Asked of
+                                # the open transaction: uncommitted pages aren't on disk yet.
+                                size_due = (idx + 1) % _SIZE_CHECK_EVERY == 0 or idx + 1 == total
+                                if size_due and (cur_mb := parser.database_size_bytes() / (1024 * 1024)) >= db_size_limit_mb:
+                                    status_container.warning(
+                                        f"Database reached {cur_mb:.1f} MB, exceeding the limit ({db_size_limit_mb} MB). Import has been stopped."
+                                    )
+                                    # Update progress to current point and stop processing more files
+                                    progress.progress(int(((idx + 1) / total) * 100), text=f"Processed {idx + 1}/{total} file(s)")
+                                    break
+                            except Exception as fe:
+                                tb = traceback.format_exc(limit=_LOG_TB_LIMIT)
+                                msg = f"[FILE: {fname}] {fe}\n{tb}"
+                                file_errors.append(msg)
+                                st.session_state['import_error_logs'].append(msg)
+                                status_container.error(f"Failed to import {fname}: {fe}")
+
+                            # Update progress
+                            if (idx + 1) % progress_step == 0 or idx + 1 == total:
                                 progress.progress(int(((idx + 1) / total) * 100), text=f"Processed {idx + 1}/{total} file(s)")
-                                break
-                        except Exception as fe:
-                            tb = traceback.format_exc()
-                            msg = f"[FILE: {fname}] {fe}\n{tb}"
-                            file_errors.append(msg)
-                            st.session_state['import_error_logs'].append(msg)
-                            status_container.error(f"Failed to import {fname}: {fe}")
-                        finally:
-                            # Clean up the temporary file
-                            if os.path.exists(temp_file_path):
-                                try:
-                                    os.remove(temp_file_path)
-                                except Exception:
-                                    pass
-
-                        # Update progress
-                        progress.progress(int(((idx + 1) / total) * 100), text=f"Processed {idx + 1}/{total} file(s)")
-
-                    # Finalize
-                    if success_count > 0:
-                        st.success(f"Imported {success_count} of {total} file(s) successfully.")
-                        st.session_state['data_imported'] = True
-                        st.session_state['db_path'] = db_path
-                    else:
-                        st.error("No files were imported successfully. See the error log below.")
-                        if not file_errors:
-                            st.info("Tip: Make sure you selected valid MyChart XML files. If you exported a ZIP, unzip it first and upload the .xml file(s).")
-
-                    # Show error log summary if any errors occurred this run
-                    if file_errors:
-                        with st.expander("Error log (this run)", expanded=True):
-                            st.code("\n\n".join(file_errors), language="text")
-                    # Also provide a persistent log viewer
-                    if st.session_state['import_error_logs']:
-                        with st.expander("Persistent import error log", expanded=False):
-                            st.code("\n\n".join(st.session_state['import_error_logs'][-100:]), language="text")
-                            st.download_button(
-                                label="Download full error log",
-                                data="\n\n".join(st.session_state['import_error_logs']).encode("utf-8"),
-                                file_name="import_error_log.txt",
-                                mime="text/plain",
-                            )
-                            if st.button("Clear persistent error log", key="clear_error_log_run"):
-                                st.session_state['import_error_logs'] = []
-                                st.toast("Cleared error log")
-                                st.rerun()
+                finally:
+                    if pool is not None:
+                        # Drop parses that are no longer needed (e.g. size limit reached)
+                        pool.shutdown(wait=False, cancel_futures=True)
+
+                # Finalize
+                if success_count > 0:
+                    # Keep the on-disk size honest for the next limit check
+                    compact_after_import(engine)
+                    st.success(f"Imported {success_count} of {total} file(s) successfully.")
+                    st.session_state['data_imported'] = True
+                    st.session_state['db_path'] = db_path
+                    # Invalidate cached patient context on the explorer page
+                    _bump_data_version()
+                else:
+                    st.error("No files were imported successfully. See the error log below.")
+                    if not file_errors:
+                        st.info("Tip: Make sure you selected valid MyChart XML files. If you exported a ZIP, unzip it first and upload the .xml file(s).")
 
-                except Exception as e:
-                    # Unexpected top-level failure
-                    tb = traceback.format_exc()
-                    msg = f"[FATAL] {e}\n{tb}"
-                    st.session_state['import_error_logs'].append(msg)
-                    st.error(f"An unexpected error occurred during import: {e}")
-                    with st.expander("Error details", expanded=True):
-                        st.code(tb, language="text")
-    else:
-        st.caption("No files selected yet. Upload one or more MyChart .xml exports to enable 'Import Data'.")
+                # Show error log summary if any errors occurred this run
+                if file_errors:
+                    with st.expander("Error log (this run)", expanded=True):
+                        st.code("\n\n".join(file_errors), language="text")
+                # The persistent log viewer is at the bottom of the page
+
+            except Exception as e:
+                # Unexpected top-level failure
+                tb = traceback.format_exc(limit=_LOG_TB_LIMIT)
+                msg = f"[FATAL] {e}\n{tb}"
+                st.session_state['import_error_logs'].append(msg)
+                st.error(f"An unexpected error occurred during import: {e}")
+                with st.expander("Error details", expanded=True):
+                    st.code(tb, language="text")
 
 with tab_fhir:
     st.subheader("Connect to Epic via SMART on FHIR")
     st.caption("Beta: Authenticate with your Epic sandbox and sync clinical notes into your local database.")
-    from modules.config import save_configuration
     from modules.fhir_client import (
         generate_pkce,
         build_authorize_url,
@@ -216,7 +334,6 @@ with tab_fhir:
         OAuthTokens,
         fetch_document_references,
         fetch_binary,
-        discover_smart_configuration,
         fetch_patient,
         fetch_allergy_intolerances,
         fetch_conditions,
@@ -238,9 +355,9 @@ with tab_fhir:
         ingest_observations,
         ingest_procedures,
         ingest_diagnostic_reports_as_notes,
+        prefetch_binaries,
     )
     from modules.database import (
-        get_session,
         Patient as DBPatient,
         Allergy as DBAllergy,
         Problem as DBProblem,
@@ -322,7 +439,7 @@ with tab_fhir:
                 if not auth_url or not token_url:
                     try:
                         with st.spinner("Discovering OAuth endpoints from SMART config…"):
-                            cfg = discover_smart_configuration(st.session_state['fhir_base_url'])
+                            cfg = _discover_smart_cached(st.session_state['fhir_base_url'])
                             st.session_state['fhir_auth_url'] = cfg.get('authorization_endpoint', st.session_state.get('fhir_auth_url', ''))
                             st.session_state['fhir_token_url'] = cfg.get('token_endpoint', st.session_state.get('fhir_token_url', ''))
                         st.info("Filled missing OAuth URLs via SMART discovery.")
@@ -335,13 +452,7 @@ with tab_fhir:
                     "fhir_token_url": st.session_state.get('fhir_token_url',''),
                 })
                 st.session_state['epic_applied_base'] = selected_base
-                try:
-                    st.rerun()
-                except Exception:
-                    try:
-                        st.experimental_rerun()  # Streamlit <1.25
-                    except Exception:
-                        pass
+                st.rerun()
         # Show current URLs in small text right under the list
         if st.session_state.get('fhir_base_url'):
             st.caption(f"FHIR Base: {st.session_state.get('fhir_base_url')}")
@@ -400,7 +511,8 @@ with tab_fhir:
     st.session_state.setdefault('fhir_pkce_verifier', '')
     st.session_state.setdefault('fhir_state', '')
     st.session_state.setdefault('fhir_tokens', None)
-    st.session_state.setdefault('fhir_pkce_verifier_map', {})  # state -> verifier
+    # state -> verifier, oldest first; bounded so abandoned attempts don't accumulate
+    st.session_state.setdefault('fhir_pkce_verifier_map', OrderedDict())
 
     # Start auth
     if st.button("Start OAuth2 Authorization", key="start_oauth"):
@@ -409,8 +521,12 @@ with tab_fhir:
         st.session_state['fhir_state'] = os.urandom(8).hex()
         # Track verifier per state to avoid mismatches if user starts multiple auth attempts
         try:
-            vmap = st.session_state.get('fhir_pkce_verifier_map') or {}
+            vmap = st.session_state.get('fhir_pkce_verifier_map')
+            if not isinstance(vmap, OrderedDict):
+                vmap = OrderedDict(vmap or {})
             vmap[st.session_state['fhir_state']] = verifier
+            while len(vmap) > _MAX_PENDING_VERIFIERS:
+                vmap.popitem(last=False)
             st.session_state['fhir_pkce_verifier_map'] = vmap
         except Exception:
             pass
@@ -436,30 +552,8 @@ with tab_fhir:
         st.caption("After authorizing, you'll be redirected back here. We'll automatically capture the authorization code and exchange it for tokens.")
 
     # Code exchange
-    # Try to auto-capture code from query params if user was redirected back to this page
-    code_default = ""
-    try:
-        # Streamlit 1.32+ exposes st.query_params as a dict-like
-        try:
-            params = st.query_params  # type: ignore[attr-defined]
-        except Exception:
-            params = st.experimental_get_query_params()  # type: ignore[attr-defined]
-        if isinstance(params, dict):
-            raw = params.get('code')
-            if isinstance(raw, list):
-                code_default = raw[0] if raw else ""
-            elif isinstance(raw, str):
-                code_default = raw
-            # Also capture state for verifier lookup
-            raw_state = params.get('state')
-            if isinstance(raw_state, list):
-                st.session_state['pending_fhir_state'] = raw_state[0] if raw_state else st.session_state.get('pending_fhir_state', '')
-            elif isinstance(raw_state, str):
-                st.session_state['pending_fhir_state'] = raw_state
-    except Exception:
-        pass
-    if not code_default:
-        code_default = st.session_state.get('pending_fhir_code', "")
+    # A code from the redirect back to this page was captured at the top of the page
+    code_default = st.session_state.get('pending_fhir_code', "")
     code = st.text_input("Authorization Code", value=code_default)
     # Helpful hint if state suggests a different in-flight verifier
     if st.session_state.get('pending_fhir_state') and st.session_state.get('fhir_state') and st.session_state['pending_fhir_state'] != st.session_state['fhir_state']:
@@ -527,8 +621,14 @@ with tab_fhir:
                         )
     # Removed manual "Exchange Code for Tokens" — auto-exchange handles this when code is present
 
-    # Synchronize all clinical data (appears after token exchange)
-    if st.session_state.get('fhir_tokens'):
+    # Token context read once per rerun; the handlers below share it
+    _tok = st.session_state.get('fhir_tokens')
+    fhir_pid = getattr(_tok, 'patient_id', None) if _tok else None
+    fhir_granted_scopes = _scope_set(getattr(_tok, 'scope', '') or '') if _tok else frozenset()
+
+    # Everything below needs an access token; one guard covers all sections
+    if _tok:
+        # Synchronize all clinical data (appears after token exchange)
         st.divider()
         st.subheader("Synchronize all clinical data")
         colS1, colS2 = st.columns(2)
@@ -540,12 +640,12 @@ with tab_fhir:
             try:
                 # Prepare DB
                 db_key = st.session_state.get('db_encryption_key')
-                engine = get_db_engine(db_path, key=db_key)
+                engine = get_cached_engine(db_path, key=db_key)
                 setup_database(engine)
 
                 base = st.session_state['fhir_base_url']
                 tokens = st.session_state['fhir_tokens']
-                pid = getattr(tokens, 'patient_id', None)
+                pid = fhir_pid
 
                 summary = {
                     'patient_upserted': False,
@@ -563,14 +663,40 @@ with tab_fhir:
                     'errors': [],
                 }
 
-                prog = st.progress(0, text="Starting synchronization…")
+                prog = st.progress(0, text="Fetching resources from the FHIR server…")
                 step = 0
                 total_steps = 9
 
+                # Issue every read up front: the HTTPS round trips overlap while the
+                # steps below ingest (SQLite has one writer) in the usual order.
+                # A failed fetch re-raises from .result() inside its step's try.
+                from concurrent.futures import ThreadPoolExecutor
+                since_arg = since_all or None
+                fetch_calls = {
+                    'allergies': (fetch_allergy_intolerances, {}),
+                    'conditions': (fetch_conditions, {}),
+                    'med_statements': (fetch_medication_statements, {}),
+                    'med_requests': (fetch_medication_requests, {}),
+                    'immunizations': (fetch_immunizations, {}),
+                    'vitals': (fetch_observations, {'category': "vital-signs"}),
+                    'labs': (fetch_observations, {'category': "laboratory"}),
+                    'procedures': (fetch_procedures, {}),
+                    'docrefs': (fetch_document_references, {}),
+                    'reports': (fetch_diagnostic_reports, {}),
+                }
+                fetch_pool = ThreadPoolExecutor(max_workers=8)
+                fetched = {
+                    name: fetch_pool.submit(fn, base, tokens, patient_id=pid, since=since_arg, **kw)
+                    for name, (fn, kw) in fetch_calls.items()
+                }
+                if pid:
+                    fetched['patient'] = fetch_pool.submit(fetch_patient, base, tokens, pid)
+                fetch_pool.shutdown(wait=False)
+
                 # 1. Patient demographics
                 try:
                     if pid:
-                        pres = fetch_patient(base, tokens, pid)
+                        pres = fetched['patient'].result()
                         upsert_patient(engine, pres)
                         summary['patient_upserted'] = True
                 except Exception as e:
@@ -579,7 +705,7 @@ with tab_fhir:
 
                 # 2. Allergies
                 try:
-                    items = fetch_allergy_intolerances(base, tokens, patient_id=pid, since=since_all or None)
+                    items = fetched['allergies'].result()
                     summary['allergies'] = ingest_allergies(engine, items)
                 except Exception as e:
                     summary['errors'].append(f"Allergies: {e}")
@@ -587,7 +713,7 @@ with tab_fhir:
 
                 # 3. Problems (Conditions)
                 try:
-                    items = fetch_conditions(base, tokens, patient_id=pid, since=since_all or None)
+                    items = fetched['conditions'].result()
                     summary['problems'] = ingest_conditions(engine, items)
                 except Exception as e:
                     summary['errors'].append(f"Problems: {e}")
@@ -595,8 +721,8 @@ with tab_fhir:
 
                 # 4. Medications (Statements + Requests)
                 try:
-                    stmts = fetch_medication_statements(base, tokens, patient_id=pid, since=since_all or None)
-                    reqs = fetch_medication_requests(base, tokens, patient_id=pid, since=since_all or None)
+                    stmts = fetched['med_statements'].result()
+                    reqs = fetched['med_requests'].result()
                     summary['medications'] = ingest_medications(engine, stmts, reqs)
                 except Exception as e:
                     summary['errors'].append(f"Medications: {e}")
@@ -604,7 +730,7 @@ with tab_fhir:
 
                 # 5. Immunizations
                 try:
-                    items = fetch_immunizations(base, tokens, patient_id=pid, since=since_all or None)
+                    items = fetched['immunizations'].result()
                     summary['immunizations'] = ingest_immunizations(engine, items)
                 except Exception as e:
                     summary['errors'].append(f"Immunizations: {e}")
@@ -612,8 +738,8 @@ with tab_fhir:
 
                 # 6. Observations (Vitals + Labs)
                 try:
-                    vitals = fetch_observations(base, tokens, patient_id=pid, category="vital-signs", since=since_all or None)
-                    labs = fetch_observations(base, tokens, patient_id=pid, category="laboratory", since=since_all or None)
+                    vitals = fetched['vitals'].result()
+                    labs = fetched['labs'].result()
                     nv, nr = ingest_observations(engine, vitals + labs)
                     summary['vitals'] = nv
                     summary['lab_results'] = nr
@@ -623,7 +749,7 @@ with tab_fhir:
 
                 # 7. Procedures
                 try:
-                    items = fetch_procedures(base, tokens, patient_id=pid, since=since_all or None)
+                    items = fetched['procedures'].result()
                     summary['procedures'] = ingest_procedures(engine, items)
                 except Exception as e:
                     summary['errors'].append(f"Procedures: {e}")
@@ -637,8 +763,9 @@ with tab_fhir:
 
                 # 8. Notes via DocumentReference
                 try:
-                    docs = fetch_document_references(base, tokens, patient_id=pid, since=since_all or None)
-                    new_rows, skipped = ingest_document_references(engine, docs, _bin_loader)
+                    docs = fetched['docrefs'].result()
+                    loader = _bin_loader if skip_bin_all else prefetch_binaries(docs, _bin_loader)
+                    new_rows, skipped = ingest_document_references(engine, docs, loader)
                     summary['notes_docref'] = new_rows
                     summary['notes_docref_skipped'] = skipped
                 except Exception as e:
@@ -647,8 +774,9 @@ with tab_fhir:
 
                 # 9. Notes via DiagnosticReport.presentedForm
                 try:
-                    reports = fetch_diagnostic_reports(base, tokens, patient_id=pid, since=since_all or None)
-                    new_rows, skipped = ingest_diagnostic_reports_as_notes(engine, reports, _bin_loader)
+                    reports = fetched['reports'].result()
+                    loader = _bin_loader if skip_bin_all else prefetch_binaries(reports, _bin_loader)
+                    new_rows, skipped = ingest_diagnostic_reports_as_notes(engine, reports, loader)
                     summary['notes_diagnostic'] = new_rows
                     summary['notes_diagnostic_skipped'] = skipped
                 except Exception as e:
@@ -661,13 +789,8 @@ with tab_fhir:
                     summary['immunizations'], summary['vitals'], summary['lab_results'],
                     summary['procedures'], summary['notes_docref'], summary['notes_diagnostic'],
                 ]):
-                    from datetime import datetime, timezone
-                    now_iso = datetime.now(timezone.utc).isoformat()
-                    st.session_state['last_fhir_sync'] = now_iso
-                    try:
-                        save_configuration({"last_fhir_sync": now_iso})
-                    except Exception:
-                        pass
+                    _mark_sync_now()
+                    _bump_data_version()
 
                 # Show summary
                 st.success("Synchronization complete")
@@ -687,27 +810,27 @@ with tab_fhir:
                     "errors": summary['errors'],
                 })
                 st.session_state['data_imported'] = True
+                _bump_data_version()
             except Exception as e:
                 tb = traceback.format_exc()
                 st.error(f"Synchronize all failed: {e}")
                 with st.expander("Error details"):
                     st.code(tb)
 
-    # Refresh
-    if st.session_state.get('fhir_tokens') and getattr(st.session_state['fhir_tokens'], 'refresh_token', None):
-        if st.button("Refresh Access Token", key="refresh_access_token"):
-            try:
-                st.session_state['fhir_tokens'] = refresh_token_call(
-                    st.session_state['fhir_token_url'],
-                    st.session_state['fhir_tokens'].refresh_token,
-                    st.session_state['fhir_client_id'],
-                )
-                st.toast("Refreshed access token.", icon="🔁")
-            except Exception as e:
-                st.error(f"Refresh failed: {e}")
+        # Refresh
+        if getattr(_tok, 'refresh_token', None):
+            if st.button("Refresh Access Token", key="refresh_access_token"):
+                try:
+                    st.session_state['fhir_tokens'] = refresh_token_call(
+                        st.session_state['fhir_token_url'],
+                        st.session_state['fhir_tokens'].refresh_token,
+                        st.session_state['fhir_client_id'],
+                    )
+                    st.toast("Refreshed access token.", icon="🔁")
+                except Exception as e:
+                    st.error(f"Refresh failed: {e}")
 
-    # Token debug panel: show granted scopes and context
-    if st.session_state.get('fhir_tokens'):
+        # Token debug panel: show granted scopes and context
         t = st.session_state['fhir_tokens']
         with st.expander("Token details (granted scopes)", expanded=False):
             st.write({
@@ -716,11 +839,10 @@ with tab_fhir:
                 "token_type": getattr(t, 'token_type', None),
             })
 
-    # Patient demographics
-    if st.session_state.get('fhir_tokens'):
+        # Patient demographics
         st.divider()
         st.subheader("Patient Demographics")
-        pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+        pid = fhir_pid
         st.caption(f"Patient ID from token: {pid or '(not provided)'}")
         colp1, colp2 = st.columns(2)
         with colp1:
@@ -730,10 +852,11 @@ with tab_fhir:
                 else:
                     try:
                         db_key = st.session_state.get('db_encryption_key')
-                        engine = get_db_engine(db_path, key=db_key)
+                        engine = get_cached_engine(db_path, key=db_key)
                         setup_database(engine)
                         pres = fetch_patient(st.session_state['fhir_base_url'], st.session_state['fhir_tokens'], pid)
                         upsert_patient(engine, pres)
+                        _bump_data_version()
                         st.success("Saved patient demographics to database.")
                         with st.expander("FHIR Patient (raw)", expanded=False):
                             st.json(pres)
@@ -743,35 +866,21 @@ with tab_fhir:
             if st.button("Preview Patient from DB", key="preview_patient_db"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    session = get_session(engine)
-                    try:
-                        row = session.query(DBPatient).first()
-                    finally:
-                        try:
-                            session.close()
-                        except Exception:
-                            pass
-                    if row:
-                        st.json({
-                            "mrn": row.mrn,
-                            "full_name": row.full_name,
-                            "dob": row.dob,
-                            "gender": row.gender,
-                            "marital_status": row.marital_status,
-                            "race": row.race,
-                            "ethnicity": row.ethnicity,
-                            "deceased": row.deceased,
-                            "deceased_date": row.deceased_date,
-                        })
+                    found = _latest_rows(
+                        engine, DBPatient,
+                        ("mrn", "full_name", "dob", "gender", "marital_status", "race", "ethnicity", "deceased", "deceased_date"),
+                        limit=1, newest=False,
+                    )
+                    if found:
+                        st.json(found[0])
                     else:
                         st.info("No patient row found yet. Click 'Fetch Patient Info' first or run a notes sync (which creates a placeholder).")
                 except Exception as e:
                     st.error(f"Failed to read Patient from DB: {e}")
 
-    # Allergies
-    if st.session_state.get('fhir_tokens'):
+        # Allergies
         st.divider()
         st.subheader("Allergies")
         colA1, colA2 = st.columns(2)
@@ -780,9 +889,9 @@ with tab_fhir:
             if st.button("Fetch and Import Allergies", key="fetch_import_allergies"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+                    pid = fhir_pid
                     items = fetch_allergy_intolerances(
                         st.session_state['fhir_base_url'],
                         st.session_state['fhir_tokens'],
@@ -791,10 +900,8 @@ with tab_fhir:
                     )
                     new_count = ingest_allergies(engine, items)
                     if new_count > 0:
-                        from datetime import datetime, timezone
-                        now_iso = datetime.now(timezone.utc).isoformat()
-                        st.session_state['last_fhir_sync'] = now_iso
-                        save_configuration({"last_fhir_sync": now_iso})
+                        _mark_sync_now()
+                        _bump_data_version()
                         st.success(f"Imported {new_count} allergy record(s).")
                     else:
                         st.info("No new allergy records imported.")
@@ -807,33 +914,17 @@ with tab_fhir:
             if st.button("Preview Allergies from DB", key="preview_allergies_db"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    session = get_session(engine)
-                    try:
-                        rows = session.query(DBAllergy).order_by(DBAllergy.id.desc()).limit(20).all()
-                    finally:
-                        try:
-                            session.close()
-                        except Exception:
-                            pass
+                    rows = _latest_rows(engine, DBAllergy, ("substance", "reaction", "status", "effective_date"))
                     if rows:
-                        st.dataframe([
-                            {
-                                "substance": r.substance,
-                                "reaction": r.reaction,
-                                "status": r.status,
-                                "effective_date": r.effective_date,
-                            }
-                            for r in rows
-                        ])
+                        _show_rows(rows)
                     else:
                         st.info("No allergies in database yet.")
                 except Exception as e:
                     st.error(f"Failed to read allergies from DB: {e}")
 
-    # Problems (Conditions)
-    if st.session_state.get('fhir_tokens'):
+        # Problems (Conditions)
         st.divider()
         st.subheader("Problems (Conditions)")
         colC1, colC2 = st.columns(2)
@@ -842,9 +933,9 @@ with tab_fhir:
             if st.button("Fetch and Import Problems", key="fetch_import_conditions"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+                    pid = fhir_pid
                     items = fetch_conditions(
                         st.session_state['fhir_base_url'],
                         st.session_state['fhir_tokens'],
@@ -853,10 +944,8 @@ with tab_fhir:
                     )
                     new_count = ingest_conditions(engine, items)
                     if new_count > 0:
-                        from datetime import datetime, timezone
-                        now_iso = datetime.now(timezone.utc).isoformat()
-                        st.session_state['last_fhir_sync'] = now_iso
-                        save_configuration({"last_fhir_sync": now_iso})
+                        _mark_sync_now()
+                        _bump_data_version()
                         st.success(f"Imported {new_count} problem record(s).")
                     else:
                         st.info("No new problem records imported.")
@@ -869,33 +958,17 @@ with tab_fhir:
             if st.button("Preview Problems from DB", key="preview_problems_db"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    session = get_session(engine)
-                    try:
-                        rows = session.query(DBProblem).order_by(DBProblem.id.desc()).limit(20).all()
-                    finally:
-                        try:
-                            session.close()
-                        except Exception:
-                            pass
+                    rows = _latest_rows(engine, DBProblem, ("problem_name", "status", "onset_date", "resolved_date"))
                     if rows:
-                        st.dataframe([
-                            {
-                                "problem_name": r.problem_name,
-                                "status": r.status,
-                                "onset_date": r.onset_date,
-                                "resolved_date": r.resolved_date,
-                            }
-                            for r in rows
-                        ])
+                        _show_rows(rows)
                     else:
                         st.info("No problems in database yet.")
                 except Exception as e:
                     st.error(f"Failed to read problems from DB: {e}")
 
-    # Medications
-    if st.session_state.get('fhir_tokens'):
+        # Medications
         st.divider()
         st.subheader("Medications")
         colM1, colM2 = st.columns(2)
@@ -904,27 +977,25 @@ with tab_fhir:
             if st.button("Fetch and Import Medications", key="fetch_import_medications"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+                    pid = fhir_pid
                     statements = fetch_medication_statements(
                         st.session_state['fhir_base_url'],
                         st.session_state['fhir_tokens'],
                         patient_id=pid,
                         since=since_med or None,
                     )
-                    requests = fetch_medication_requests(
+                    med_requests = fetch_medication_requests(
                         st.session_state['fhir_base_url'],
                         st.session_state['fhir_tokens'],
                         patient_id=pid,
                         since=since_med or None,
                     )
-                    new_count = ingest_medications(engine, statements, requests)
+                    new_count = ingest_medications(engine, statements, med_requests)
                     if new_count > 0:
-                        from datetime import datetime, timezone
-                        now_iso = datetime.now(timezone.utc).isoformat()
-                        st.session_state['last_fhir_sync'] = now_iso
-                        save_configuration({"last_fhir_sync": now_iso})
+                        _mark_sync_now()
+                        _bump_data_version()
                         st.success(f"Imported {new_count} medication record(s).")
                     else:
                         st.info("No new medication records imported.")
@@ -937,34 +1008,17 @@ with tab_fhir:
             if st.button("Preview Medications from DB", key="preview_medications_db"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    session = get_session(engine)
-                    try:
-                        rows = session.query(DBMedication).order_by(DBMedication.id.desc()).limit(20).all()
-                    finally:
-                        try:
-                            session.close()
-                        except Exception:
-                            pass
+                    rows = _latest_rows(engine, DBMedication, ("medication_name", "instructions", "status", "start_date", "end_date"))
                     if rows:
-                        st.dataframe([
-                            {
-                                "medication_name": r.medication_name,
-                                "instructions": r.instructions,
-                                "status": r.status,
-                                "start_date": r.start_date,
-                                "end_date": r.end_date,
-                            }
-                            for r in rows
-                        ])
+                        _show_rows(rows)
                     else:
                         st.info("No medications in database yet.")
                 except Exception as e:
                     st.error(f"Failed to read medications from DB: {e}")
 
-    # Immunizations
-    if st.session_state.get('fhir_tokens'):
+        # Immunizations
         st.divider()
         st.subheader("Immunizations")
         colI1, colI2 = st.columns(2)
@@ -973,17 +1027,11 @@ with tab_fhir:
             if st.button("Fetch and Import Immunizations", key="fetch_import_immunizations"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+                    pid = fhir_pid
                     # Pre-check scopes and patient context to avoid 403s
-                    scopes = (getattr(st.session_state['fhir_tokens'], 'scope', '') or '').split()
-                    has_immun_scope = any(s in scopes for s in [
-                        'patient/Immunization.read',
-                        'patient/*.read',
-                        'user/Immunization.read',
-                        'user/*.read',
-                    ])
+                    has_immun_scope = not fhir_granted_scopes.isdisjoint(_IMMUNIZATION_SCOPES)
                     if not pid:
                         st.warning("Token is missing patient context. Ensure your app requests 'launch/patient' and Epic returns 'patient' in token response.")
                         st.stop()
@@ -998,10 +1046,8 @@ with tab_fhir:
                     )
                     new_count = ingest_immunizations(engine, items)
                     if new_count > 0:
-                        from datetime import datetime, timezone
-                        now_iso = datetime.now(timezone.utc).isoformat()
-                        st.session_state['last_fhir_sync'] = now_iso
-                        save_configuration({"last_fhir_sync": now_iso})
+                        _mark_sync_now()
+                        _bump_data_version()
                         st.success(f"Imported {new_count} immunization record(s).")
                     else:
                         st.info("No new immunization records imported.")
@@ -1014,31 +1060,17 @@ with tab_fhir:
             if st.button("Preview Immunizations from DB", key="preview_immunizations_db"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    session = get_session(engine)
-                    try:
-                        rows = session.query(DBImmunization).order_by(DBImmunization.id.desc()).limit(20).all()
-                    finally:
-                        try:
-                            session.close()
-                        except Exception:
-                            pass
+                    rows = _latest_rows(engine, DBImmunization, ("vaccine_name", "date_administered"))
                     if rows:
-                        st.dataframe([
-                            {
-                                "vaccine_name": r.vaccine_name,
-                                "date_administered": r.date_administered,
-                            }
-                            for r in rows
-                        ])
+                        _show_rows(rows)
                     else:
                         st.info("No immunizations in database yet.")
                 except Exception as e:
                     st.error(f"Failed to read immunizations from DB: {e}")
 
-    # Observations (Vitals & Labs)
-    if st.session_state.get('fhir_tokens'):
+        # Observations (Vitals & Labs)
         st.divider()
         st.subheader("Observations: Vitals and Labs")
         colO1, colO2 = st.columns(2)
@@ -1047,30 +1079,28 @@ with tab_fhir:
             if st.button("Fetch and Import Vitals + Labs", key="fetch_import_observations"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
-                    # Fetch vitals and labs separately then combine
-                    vitals = fetch_observations(
-                        st.session_state['fhir_base_url'],
-                        st.session_state['fhir_tokens'],
-                        patient_id=pid,
-                        category="vital-signs",
-                        since=since_obs or None,
-                    )
-                    labs = fetch_observations(
-                        st.session_state['fhir_base_url'],
-                        st.session_state['fhir_tokens'],
-                        patient_id=pid,
-                        category="laboratory",
-                        since=since_obs or None,
-                    )
+                    pid = fhir_pid
+                    # Fetch vitals and labs concurrently (both are paginated HTTPS) then combine
+                    from concurrent.futures import ThreadPoolExecutor
+                    with ThreadPoolExecutor(max_workers=2) as ex:
+                        fv, fl = (
+                            ex.submit(
+                                fetch_observations,
+                                st.session_state['fhir_base_url'],
+                                st.session_state['fhir_tokens'],
+                                patient_id=pid,
+                                category=category,
+                                since=since_obs or None,
+                            )
+                            for category in ("vital-signs", "laboratory")
+                        )
+                        vitals, labs = fv.result(), fl.result()
                     new_vitals, new_results = ingest_observations(engine, vitals + labs)
                     if (new_vitals + new_results) > 0:
-                        from datetime import datetime, timezone
-                        now_iso = datetime.now(timezone.utc).isoformat()
-                        st.session_state['last_fhir_sync'] = now_iso
-                        save_configuration({"last_fhir_sync": now_iso})
+                        _mark_sync_now()
+                        _bump_data_version()
                         st.success(f"Imported {new_vitals} vital(s) and {new_results} lab result(s).")
                     else:
                         st.info("No new vitals or lab results imported.")
@@ -1083,50 +1113,27 @@ with tab_fhir:
             if st.button("Preview Vitals and Labs from DB", key="preview_observations_db"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    session = get_session(engine)
-                    try:
-                        vit_rows = session.query(DBVital).order_by(DBVital.id.desc()).limit(20).all()
-                        res_rows = session.query(DBResult).order_by(DBResult.id.desc()).limit(20).all()
-                    finally:
-                        try:
-                            session.close()
-                        except Exception:
-                            pass
+                    vit_rows = _latest_rows(engine, DBVital, ("vital_sign", "value", "unit", "effective_date"))
+                    res_rows = _latest_rows(
+                        engine, DBResult,
+                        ("test_name", "value", "unit", "reference_range", "interpretation", "effective_date"),
+                    )
                     st.markdown("Latest Vitals")
                     if vit_rows:
-                        st.dataframe([
-                            {
-                                "vital_sign": r.vital_sign,
-                                "value": r.value,
-                                "unit": r.unit,
-                                "effective_date": r.effective_date,
-                            }
-                            for r in vit_rows
-                        ])
+                        _show_rows(vit_rows)
                     else:
                         st.info("No vitals in database yet.")
                     st.markdown("Latest Lab Results")
                     if res_rows:
-                        st.dataframe([
-                            {
-                                "test_name": r.test_name,
-                                "value": r.value,
-                                "unit": r.unit,
-                                "reference_range": r.reference_range,
-                                "interpretation": r.interpretation,
-                                "effective_date": r.effective_date,
-                            }
-                            for r in res_rows
-                        ])
+                        _show_rows(res_rows)
                     else:
                         st.info("No lab results in database yet.")
                 except Exception as e:
                     st.error(f"Failed to read observations from DB: {e}")
 
-    # Procedures
-    if st.session_state.get('fhir_tokens'):
+        # Procedures
         st.divider()
         st.subheader("Procedures")
         colP1, colP2 = st.columns(2)
@@ -1135,9 +1142,9 @@ with tab_fhir:
             if st.button("Fetch and Import Procedures", key="fetch_import_procedures"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+                    pid = fhir_pid
                     items = fetch_procedures(
                         st.session_state['fhir_base_url'],
                         st.session_state['fhir_tokens'],
@@ -1146,10 +1153,8 @@ with tab_fhir:
                     )
                     new_count = ingest_procedures(engine, items)
                     if new_count > 0:
-                        from datetime import datetime, timezone
-                        now_iso = datetime.now(timezone.utc).isoformat()
-                        st.session_state['last_fhir_sync'] = now_iso
-                        save_configuration({"last_fhir_sync": now_iso})
+                        _mark_sync_now()
+                        _bump_data_version()
                         st.success(f"Imported {new_count} procedure record(s).")
                     else:
                         st.info("No new procedure records imported.")
@@ -1162,32 +1167,17 @@ with tab_fhir:
             if st.button("Preview Procedures from DB", key="preview_procedures_db"):
                 try:
                     db_key = st.session_state.get('db_encryption_key')
-                    engine = get_db_engine(db_path, key=db_key)
+                    engine = get_cached_engine(db_path, key=db_key)
                     setup_database(engine)
-                    session = get_session(engine)
-                    try:
-                        rows = session.query(DBProcedure).order_by(DBProcedure.id.desc()).limit(20).all()
-                    finally:
-                        try:
-                            session.close()
-                        except Exception:
-                            pass
+                    rows = _latest_rows(engine, DBProcedure, ("procedure_name", "date", "provider"))
                     if rows:
-                        st.dataframe([
-                            {
-                                "procedure_name": r.procedure_name,
-                                "date": r.date,
-                                "provider": r.provider,
-                            }
-                            for r in rows
-                        ])
+                        _show_rows(rows)
                     else:
                         st.info("No procedures in database yet.")
                 except Exception as e:
                     st.error(f"Failed to read procedures from DB: {e}")
 
-    # Diagnostic Reports → Notes
-    if st.session_state.get('fhir_tokens'):
+        # Diagnostic Reports → Notes
         st.divider()
         st.subheader("Diagnostic Reports (as Notes)")
         since_dr = st.text_input("Sync since (ISO 8601, optional)", key="diagreports_since", value="")
@@ -1200,25 +1190,26 @@ with tab_fhir:
         if st.button("Fetch and Import Diagnostic Reports", key="fetch_import_diagreports"):
             try:
                 db_key = st.session_state.get('db_encryption_key')
-                engine = get_db_engine(db_path, key=db_key)
+                engine = get_cached_engine(db_path, key=db_key)
                 setup_database(engine)
-                pid = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+                pid = fhir_pid
                 reports = fetch_diagnostic_reports(
                     st.session_state['fhir_base_url'],
                     st.session_state['fhir_tokens'],
                     patient_id=pid,
                     since=since_dr or None,
                 )
+                # Bind server/tokens here: prefetch workers can't read st.session_state
+                base_dr, tokens_dr = st.session_state['fhir_base_url'], st.session_state['fhir_tokens']
                 def _bin_loader_dr(bid: str) -> bytes:
                     if skip_binary_dr:
                         raise RuntimeError("Binary fetching disabled")
-                    return fetch_binary(st.session_state['fhir_base_url'], st.session_state['fhir_tokens'], bid)
-                new_rows, skipped = ingest_diagnostic_reports_as_notes(engine, reports, _bin_loader_dr)
+                    return fetch_binary(base_dr, tokens_dr, bid)
+                loader = _bin_loader_dr if skip_binary_dr else prefetch_binaries(reports, _bin_loader_dr)
+                new_rows, skipped = ingest_diagnostic_reports_as_notes(engine, reports, loader)
                 if new_rows > 0:
-                    from datetime import datetime, timezone
-                    now_iso = datetime.now(timezone.utc).isoformat()
-                    st.session_state['last_fhir_sync'] = now_iso
-                    save_configuration({"last_fhir_sync": now_iso})
+                    _mark_sync_now()
+                    _bump_data_version()
                     st.success(f"Imported {new_rows} diagnostic report note(s). Skipped {skipped} without accessible content.")
                 else:
                     st.info(f"No new diagnostic report notes imported. Retrieved {len(reports)} reports; skipped {skipped} without accessible content.")
@@ -1228,20 +1219,20 @@ with tab_fhir:
                 with st.expander("Error details"):
                     st.code(tb)
 
-    # Sync notes
-    if st.session_state.get('fhir_tokens'):
+        # Sync notes
         st.divider()
         st.subheader("Sync Clinical Notes (DocumentReference)")
         since = st.text_input("Sync since (ISO 8601, optional)", value="")
         skip_binary = st.checkbox("Skip fetching Binary attachments (use inline data only)", value=False, help="Avoids 403s for direct Binary access. Uses content.attachment.data when present; otherwise skips the note.")
+        show_doc_preview = st.checkbox("Preview retrieved DocumentReference(s)", value=False, key="show_doc_preview", help="Show the first 10 fetched documents and their attachments; useful when nothing gets imported.")
         if st.button("Fetch and Import Notes", key="fetch_import_notes"):
             try:
                 # Prepare DB
                 db_key = st.session_state.get('db_encryption_key')
-                engine = get_db_engine(db_path, key=db_key)
+                engine = get_cached_engine(db_path, key=db_key)
                 setup_database(engine)
                 # Ensure patient demographics are saved if we have a patient_id
-                patient_hint = getattr(st.session_state['fhir_tokens'], 'patient_id', None)
+                patient_hint = fhir_pid
                 if patient_hint:
                     try:
                         pres = fetch_patient(st.session_state['fhir_base_url'], st.session_state['fhir_tokens'], patient_hint)
@@ -1262,8 +1253,8 @@ with tab_fhir:
                 # Quick preview to help debug when nothing is imported
                 if len(docs) == 0:
                     st.info("No DocumentReference resources returned. Check scopes, patient context, and the 'since' filter.")
-                else:
-                    with st.expander("Preview retrieved DocumentReference(s)"):
+                elif show_doc_preview:
+                    with st.expander("Preview retrieved DocumentReference(s)", expanded=True):
                         preview = []
                         for doc in docs[:10]:
                             atts = []
@@ -1275,7 +1266,7 @@ with tab_fhir:
                                 atts.append({
                                     "contentType": a.get("contentType"),
                                     "has_data": bool(a.get("data")),
-                                    "has_url": bool(a.get("url")),
+                                    "has_url": bool(url_val),
                                     "url": url_val,
                                 })
                             preview.append({
@@ -1286,18 +1277,22 @@ with tab_fhir:
                             })
                         st.json(preview)
 
+                # Bind server/tokens here: prefetch workers can't read st.session_state
+                base_nt, tokens_nt = st.session_state['fhir_base_url'], st.session_state['fhir_tokens']
                 def _bin_loader(bid: str) -> bytes:
                     if skip_binary:
                         raise RuntimeError("Binary fetching disabled")
-                    return fetch_binary(st.session_state['fhir_base_url'], st.session_state['fhir_tokens'], bid)
+                    return fetch_binary(base_nt, tokens_nt, bid)
 
-                new_rows, skipped_no_content = ingest_document_references(engine, docs, _bin_loader)
+                loader = _bin_loader if skip_binary else prefetch_binaries(
+                    docs, _bin_loader,
+                    on_progress=lambda done, n: prog.write(f"Resolved {done}/{n} Binary attachment(s)…"),
+                )
+                new_rows, skipped_no_content = ingest_document_references(engine, docs, loader)
                 if new_rows > 0:
                     st.success(f"Imported {new_rows} new note(s) from FHIR. Skipped {skipped_no_content} item(s) with no accessible content.")
-                    from datetime import datetime, timezone
-                    now_iso = datetime.now(timezone.utc).isoformat()
-                    st.session_state['last_fhir_sync'] = now_iso
-                    save_configuration({"last_fhir_sync": now_iso})
+                    _mark_sync_now()
+                    _bump_data_version()
                 else:
                     st.info(f"No new notes imported. Retrieved {len(docs)} DocumentReference(s); skipped {skipped_no_content} without accessible content.")
                     with st.expander("Debug details"):
@@ -1310,6 +1305,7 @@ with tab_fhir:
                             "doc_count": len(docs),
                         })
                 st.session_state['data_imported'] = True
+                _bump_data_version()
             except Exception as e:
                 tb = traceback.format_exc()
                 st.error(f"FHIR import failed: {e}")
@@ -1327,14 +1323,21 @@ if st.session_state.get('data_imported', False):
 # Always show persistent error log viewer at the bottom for user inspection
 if st.session_state.get('import_error_logs'):
     st.markdown("---")
-    with st.expander("Import error log (persistent)"):
-        st.code("\n\n".join(st.session_state['import_error_logs'][-100:]), language="text")
+    # A toggle rather than an expander: a collapsed expander still runs (and joins) its body
+    n_logs = len(st.session_state['import_error_logs'])
+    if st.toggle(f"Show import error log ({n_logs} entries)", key="show_error_log"):
+        log_tail, log_blob = _render_error_log(tuple(st.session_state['import_error_logs']))
+        st.code(log_tail, language="text")
         st.download_button(
             label="Download full error log",
-            data="\n\n".join(st.session_state['import_error_logs']).encode("utf-8"),
+            data=log_blob,
             file_name="import_error_log.txt",
             mime="text/plain",
             key="persistent_error_log_dl",
         )
+        if st.button("Clear persistent error log", key="clear_error_log"):
+            st.session_state['import_error_logs'].clear()
+            st.toast("Cleared error log")
+            st.rerun()
 
 render_footer()